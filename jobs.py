@@ -0,0 +1,181 @@
+import asyncio
+import functools
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+
+from server_utils import create_unique_folder, download_pdf, convert_pdf_to_images, run_io, run_cpu, submit_cpu
+from pdf2midi.main import detect_page_with_memo, detect_pages, write_midi, omr_params
+
+job_workers = int(os.environ.get("JOB_WORKERS", 2))
+job_queue_size = int(os.environ.get("JOB_QUEUE_SIZE", 16))
+job_keep = int(os.environ.get("JOB_KEEP", 100))
+
+async def convert_pdf_url(url, staff_detector, convert, cache=None, timings=None):
+    """
+    Download the PDF at url and turn it into MIDI bytes with
+    `await convert(job_dir)`, unless the result cache already has them.
+    :param timings: dict the download time and cache hits are recorded in
+    """
+    if timings is None:
+        timings = {}
+    tmp_folder = create_unique_folder()
+    try:
+        t = time.time()
+        await run_io(download_pdf, url, tmp_folder)
+        timings["download"] = time.time() - t
+
+        if cache is not None:
+            key = await run_io(cache.key, os.path.join(tmp_folder, "convert_it.pdf"), omr_params(staff_detector))
+            midi = await run_io(cache.get, key)
+            if midi is not None:
+                timings["cache"] = "hit"
+                return midi
+
+        midi = await convert(tmp_folder)
+        if cache is not None:
+            await run_io(cache.put, key, midi)
+        return midi
+    finally:
+        await run_io(shutil.rmtree, tmp_folder)
+
+class Job:
+    def __init__(self, url, staff_detector="template"):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.staff_detector = staff_detector
+        self.status = "queued"
+        self.pages_total = None
+        self.pages_done = 0
+        self.timings = {}
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.midi = None
+        self.error = None
+
+    def info(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "pages_total": self.pages_total,
+            "pages_done": self.pages_done,
+            "timings": self.timings,
+            "queued_for": (self.started or time.time()) - self.submitted,
+            "error": self.error}
+
+class JobQueue:
+    """
+    Bounded queue of pdf_to_midi jobs run by `workers` background tasks.
+    Finished jobs are kept (with their MIDI) until `keep` newer ones finished.
+    """
+    def __init__(self, maxsize=job_queue_size, workers=job_workers, keep=job_keep, cache=None):
+        self.cache = cache
+        self.maxsize = maxsize
+        self.workers = workers
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.tasks = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_time = 0.0
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.maxsize)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def submit(self, url, staff_detector="template"):
+        # raises asyncio.QueueFull when the queue is at its limit
+        job = Job(url, staff_detector)
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_size": self.maxsize,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "mean_job_time": self.total_time / self.completed if self.completed else None}
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            self.running += 1
+            try:
+                await self.run(job)
+                self.completed += 1
+                self.total_time += job.finished - job.started
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                job.finished = time.time()
+                self.failed += 1
+            finally:
+                self.running -= 1
+                self.queue.task_done()
+                self._forget_old()
+
+    def _forget_old(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[job_id]
+
+    async def run(self, job):
+        job.status = "running"
+        job.started = time.time()
+        try:
+            job.midi = await convert_pdf_url(job.url, job.staff_detector,
+                functools.partial(self.convert, job), self.cache, job.timings)
+            job.status = "done"
+        finally:
+            job.finished = time.time()
+
+    async def convert(self, job, tmp_folder):
+        t = time.time()
+        pages = await run_cpu(convert_pdf_to_images, tmp_folder)
+        job.pages_total = len(pages)
+        job.timings["render"] = time.time() - t
+        job.timings["pages"] = [None] * len(pages)
+        started = [None] * len(pages)
+
+        def page_done(i, future):
+            if future.exception() is None:
+                job.timings["pages"][i] = time.time() - started[i]
+                job.pages_done += 1
+
+        def submit(i, scale_memo):
+            started[i] = time.time()
+            future = submit_cpu(detect_page_with_memo, pages[i], scale_memo, job.staff_detector)
+            future.add_done_callback(functools.partial(page_done, i))
+            return future
+
+        def detect(i, scale_memo):
+            return submit(i, scale_memo).result()
+
+        def detect_rest(indices, scale_memo):
+            # side by side on the process pool
+            futures = [submit(i, scale_memo) for i in indices]
+            return [future.result()[0] for future in futures]
+
+        # detect_pages blocks on the pool, so it runs on an I/O thread
+        note_groups = await run_io(detect_pages, len(pages), detect, detect_rest)
+
+        t = time.time()
+        midi = await run_io(write_midi, note_groups, tmp_folder)
+        job.timings["midi"] = time.time() - t
+        return midi
@@ -2,8 +2,138 @@ import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 
-def fit(img, templates, start_percent, stop_percent, threshold):
-    img_width, img_height = img.shape[::-1]
+# coarse stage: page and templates are shrunk by this factor before the
+# scales are scored, then only `refine_steps` scales on each side of the
+# best `coarse_candidates` scales are matched at full resolution.
+coarse_factor = 0.25
+coarse_candidates = 2
+refine_steps = 2
+# smallest template side (in pixels, at scale 1) the coarse stage may shrink to;
+# small symbols are scored on a less downsampled page instead
+coarse_min_side = 8
+
+# with peaks=True hits are reduced to local maxima of the score map within
+# this share of the template size, so one symbol gives one hit
+peak_radius = 0.5
+
+# process-wide pyramid of pre-scaled templates,
+# (id(template), scale, factor) -> (template, scaled template)
+_template_cache = {}
+
+def scaled_template(template, scale, factor=1.0):
+    key = (id(template), scale, factor)
+    entry = _template_cache.get(key)
+    # keeping the source template in the entry stops its id from being reused
+    if entry is None or entry[0] is not template:
+        if factor == 1.0:
+            scaled = cv2.resize(template, None,
+                fx = scale, fy = scale, interpolation = cv2.INTER_CUBIC)
+        else:
+            h, w = template.shape
+            w, h = int(w * scale * factor + 0.5), int(h * scale * factor + 0.5)
+            scaled = cv2.resize(template, (max(w, 1), max(h, 1)), interpolation = cv2.INTER_AREA)
+        entry = (template, scaled)
+        _template_cache[key] = entry
+    return entry[1]
+
+def family_coarse_factor(templates):
+    # shrink factor of the coarse stage for a symbol family, above 1 when its
+    # smallest template is already thinner than coarse_min_side
+    return max(coarse_factor, float(coarse_min_side) / min(min(t.shape) for t in templates))
+
+def warm_template_cache(templates, scales):
+    factor = family_coarse_factor(templates)
+    for template in templates:
+        for scale in scales:
+            scaled_template(template, scale)
+            if factor < 1:
+                scaled_template(template, scale, factor)
+
+def template_cache_nbytes():
+    return sum(scaled.nbytes for _, scaled in _template_cache.values())
+
+def template_cache_info():
+    return {"entries": len(_template_cache), "bytes": template_cache_nbytes()}
+
+def scales_between(start_percent, stop_percent, step=3):
+    return [i/100.0 for i in range(start_percent, stop_percent + 1, step)]
+
+def band_rows(bands, template_height, img_height, margin):
+    # top rows a template hit may start at so its middle lies inside one of the bands
+    rows = []
+    for lo, hi in sorted(bands):
+        y0 = max(0, int(lo - template_height/2.0) - margin)
+        y1 = min(img_height - template_height, int(hi - template_height/2.0 + 1) + margin)
+        if y1 < y0:
+            continue
+        if rows and y0 <= rows[-1][1] + 1:
+            rows[-1] = (rows[-1][0], max(rows[-1][1], y1))
+        else:
+            rows.append((y0, y1))
+    return rows
+
+def peak_mask(result, template):
+    h, w = template.shape
+    kernel = np.ones((int(h * peak_radius) | 1, int(w * peak_radius) | 1), np.uint8)
+    return result >= cv2.dilate(result, kernel)
+
+def find_hits(result, template, threshold, peaks=False):
+    hits = result >= threshold
+    if peaks:
+        hits &= peak_mask(result, template)
+    ys, xs = np.where(hits)
+    return ys, xs, result[ys, xs]
+
+def match_template(img, template, threshold, bands=None, peaks=False):
+    # (ys, xs, scores) of every hit scoring at least `threshold`
+    if bands is None:
+        result = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
+        return find_hits(result, template, threshold, peaks)
+    h = template.shape[0]
+    ys, xs, scores = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float32)]
+    for y0, y1 in band_rows(bands, h, img.shape[0], h):
+        result = cv2.matchTemplate(img[y0:y1 + h], template, cv2.TM_CCOEFF_NORMED)
+        band_ys, band_xs, band_scores = find_hits(result, template, threshold, peaks)
+        ys.append(band_ys + y0)
+        xs.append(band_xs)
+        scores.append(band_scores)
+    return np.concatenate(ys), np.concatenate(xs), np.concatenate(scores)
+
+def match_scale(img, templates, scale, threshold, bands=None, peaks=False):
+    locations = []
+    location_count = 0
+    for template in templates:
+        template = scaled_template(template, scale)
+        result = match_template(img, template, threshold, bands, peaks)
+        location_count += len(result[0])
+        locations += [result]
+    return locations, location_count
+
+def coarse_scores(img, templates, scales, factor):
+    small = cv2.resize(img, None, fx = factor, fy = factor, interpolation = cv2.INTER_AREA)
+    small_height, small_width = small.shape
+    scores = []
+    for scale in scales:
+        score = 0.0
+        for template in templates:
+            template = scaled_template(template, scale, factor)
+            h, w = template.shape
+            if w < 2 or h < 2 or w > small_width or h > small_height:
+                continue
+            result = cv2.matchTemplate(small, template, cv2.TM_CCOEFF_NORMED)
+            score += float(result.max())
+        scores.append(score)
+    return scores
+
+def refine_band(scales, scores, candidates, steps):
+    # indices of the `candidates` best coarse scores, widened by `steps` on both sides
+    order = sorted(range(len(scales)), key=lambda i: -scores[i])[:candidates]
+    band = set()
+    for i in order:
+        band.update(range(max(0, i - steps), min(len(scales), i + steps + 1)))
+    return [scales[i] for i in sorted(band)]
+
+def sweep(img, templates, scales, threshold, bands=None, peaks=False):
     best_location_count = -1
     best_locations = []
     best_scale = 1
@@ -13,16 +143,8 @@ def fit(img, templates, start_percent, stop_percent, threshold):
 
     x = []
     y = []
-    for scale in [i/100.0 for i in range(start_percent, stop_percent + 1, 3)]:
-        locations = []
-        location_count = 0
-        for template in templates:
-            template = cv2.resize(template, None,
-                fx = scale, fy = scale, interpolation = cv2.INTER_CUBIC)
-            result = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
-            result = np.where(result >= threshold)
-            location_count += len(result[0])
-            locations += [result]
+    for scale in scales:
+        locations, location_count = match_scale(img, templates, scale, threshold, bands, peaks)
         # print("scale: {0}, hits: {1}".format(scale, location_count))
         x.append(location_count)
         y.append(scale)
@@ -37,4 +159,29 @@ def fit(img, templates, start_percent, stop_percent, threshold):
             pass
     # plt.close()
 
-    return best_locations, best_scale
\ No newline at end of file
+    return best_locations, best_scale, best_location_count
+
+def fit(img, templates, start_percent, stop_percent, threshold, coarse=True, scales=None, bands=None, peaks=False):
+    if scales is None:
+        scales = scales_between(start_percent, stop_percent)
+    # templates thinner than coarse_min_side (the 6 px wide staff templates)
+    # can't be shrunk at all, so they always take the full sweep; the scale
+    # memo narrows it after the first page. Without any band (no staff found)
+    # the full sweep matches nothing and costs nothing, so it is taken as is
+    if coarse and len(scales) > 2 * refine_steps + 1 and (bands is None or len(bands) > 0):
+        factor = family_coarse_factor(templates)
+        if factor < 1:
+            scores = coarse_scores(img, templates, scales, factor)
+            band = refine_band(scales, scores, coarse_candidates, refine_steps)
+            best_locations, best_scale, best_location_count = sweep(img, templates, band, threshold, bands, peaks)
+            if best_location_count > 0:
+                return best_locations, best_scale
+            # the coarse stage missed, sweep the scales it skipped
+            remaining = [scale for scale in scales if scale not in band]
+            locations, scale, location_count = sweep(img, templates, remaining, threshold, bands, peaks)
+            if location_count > 0:
+                return locations, scale
+            return best_locations, best_scale
+
+    best_locations, best_scale, best_location_count = sweep(img, templates, scales, threshold, bands, peaks)
+    return best_locations, best_scale
@@ -0,0 +1,63 @@
+import numpy as np
+from pdf2midi.rectangle import Rectangle
+from pdf2midi.nms import merge_boxes
+
+class Detections(object):
+    """
+    Column store of matched boxes: x, y, w, h, score and cls (template index)
+    arrays of equal length. Rectangles are only built by to_recs().
+    """
+    def __init__(self, x, y, w, h, score=None, cls=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.w = np.broadcast_to(np.asarray(w, dtype=np.float64), self.x.shape).copy()
+        self.h = np.broadcast_to(np.asarray(h, dtype=np.float64), self.x.shape).copy()
+        self.score = np.zeros(len(self.x)) if score is None else np.asarray(score, dtype=np.float64)
+        self.cls = np.zeros(len(self.x), dtype=np.int64) if cls is None else np.asarray(cls, dtype=np.int64)
+
+    @classmethod
+    def from_recs(cls, recs):
+        return cls([r.x for r in recs], [r.y for r in recs], [r.w for r in recs], [r.h for r in recs])
+
+    @classmethod
+    def concat(cls, detections):
+        detections = list(detections)
+        if not detections:
+            return cls([], [], [], [])
+        return cls(*[np.concatenate([getattr(d, name) for d in detections])
+            for name in ("x", "y", "w", "h", "score", "cls")])
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def middle_y(self):
+        return self.y + self.h / 2
+
+    def boxes(self):
+        return np.stack([self.x, self.y, self.w, self.h], axis=1)
+
+    def select(self, mask):
+        return Detections(self.x[mask], self.y[mask], self.w[mask], self.h[mask],
+            self.score[mask], self.cls[mask])
+
+    def merge(self, threshold):
+        merged, labels = merge_boxes(self.boxes(), threshold)
+        score = np.full(len(merged), -np.inf)
+        np.maximum.at(score, labels, self.score)
+        # labels are handed out in seed order, so the first member of a label is its seed
+        seeds = np.unique(labels, return_index=True)[1]
+        return Detections(merged[:, 0], merged[:, 1], merged[:, 2], merged[:, 3],
+            score, self.cls[seeds])
+
+    def near(self, box, ratio=5.0/7.0):
+        return np.abs(self.middle_y - box.middle[1]) < box.h * ratio
+
+    def overlapping(self, box):
+        ox = np.minimum(self.x + self.w, box.x + box.w) - np.maximum(self.x, box.x)
+        oy = np.minimum(self.y + self.h, box.y + box.h) - np.maximum(self.y, box.y)
+        return (ox > 0) & (oy > 0)
+
+    def to_recs(self):
+        return [Rectangle(*box) for box in zip(self.x.tolist(), self.y.tolist(),
+            self.w.tolist(), self.h.tolist())]
@@ -1,12 +1,19 @@
 import sys
 import os
 import subprocess
+import multiprocessing
+import hashlib
 import cv2
 import numpy as np
-from server_utils import file_to_bytes
-from pdf2midi.best_fit import fit
+from server_utils import read_bytes, convert_pdf_to_images
+from pdf2midi import best_fit
+from pdf2midi.best_fit import fit, scales_between, warm_template_cache, template_cache_info
 from pdf2midi.rectangle import Rectangle
+from pdf2midi.nms import merge_boxes
+from pdf2midi.detections import Detections
 from pdf2midi.note import Note
+from pdf2midi.scale_memo import ScaleMemo
+from pdf2midi.staff_detect import find_staffs
 from random import randint
 from midiutil.MidiFile import MIDIFile
 
@@ -52,155 +59,295 @@ quarter_lower, quarter_upper, quarter_thresh = 50, 150, 0.7
 half_lower, half_upper, half_thresh = 50, 150, 0.63
 whole_lower, whole_upper, whole_thresh = 50, 150, 0.65
 
-def locate_images(img, templates, start, stop, threshold):
-    locations, scale = fit(img, templates, start, stop, threshold)
+page_width, page_height = 2479, 3508
+
+# number of processes detecting pages in parallel, 1 keeps everything in-process
+omr_workers = int(os.environ.get("OMR_WORKERS", 1))
+_pool = None
+_pool_workers = 0
+
+def omr_params(staff_detector="template"):
+    # everything that changes the MIDI a page set turns into, for result caching
+    return {
+        "templates": hashlib.sha256(b"".join(img.tobytes() for img in
+            staff_imgs + sharp_imgs + flat_imgs + quarter_imgs + half_imgs + whole_imgs)).hexdigest(),
+        "ranges": [
+            (staff_lower, staff_upper, staff_thresh),
+            (sharp_lower, sharp_upper, sharp_thresh),
+            (flat_lower, flat_upper, flat_thresh),
+            (quarter_lower, quarter_upper, quarter_thresh),
+            (half_lower, half_upper, half_thresh),
+            (whole_lower, whole_upper, whole_thresh)],
+        "fit": [best_fit.coarse_factor, best_fit.coarse_candidates, best_fit.refine_steps,
+            best_fit.coarse_min_side, best_fit.peak_radius],
+        "page": [page_width, page_height],
+        "staff_detector": staff_detector}
+
+def warm_templates():
+    for templates, lower, upper in [
+            (staff_imgs, staff_lower, staff_upper),
+            (sharp_imgs, sharp_lower, sharp_upper),
+            (flat_imgs, flat_lower, flat_upper),
+            (quarter_imgs, quarter_lower, quarter_upper),
+            (half_imgs, half_lower, half_upper),
+            (whole_imgs, whole_lower, whole_upper)]:
+        warm_template_cache(templates, scales_between(lower, upper))
+    return template_cache_info()
+
+def template_cache_report():
+    # pid and template cache footprint of the process this runs in
+    return os.getpid(), template_cache_info()
+
+def locate_images(img, templates, start, stop, threshold, scale_memo=None, family=None, bands=None, peaks=True):
+    if scale_memo is None:
+        locations, scale = fit(img, templates, start, stop, threshold, bands=bands, peaks=peaks)
+    elif scale_memo.scale is None:
+        locations, scale = fit(img, templates, start, stop, threshold, bands=bands, peaks=peaks)
+        hits = sum(len(l[0]) for l in locations)
+        # a page without hits tells nothing about the scale
+        if hits > 0:
+            scale_memo.seed(scale)
+            scale_memo.record(family, hits)
+    else:
+        # no window scale inside start..stop leaves every template without hits
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+        locations, scale, hits = [empty] * len(templates), scale_memo.scale, 0
+        scales = scale_memo.scales(start, stop)
+        if scales:
+            locations, scale = fit(img, templates, start, stop, threshold, scales=scales, bands=bands, peaks=peaks)
+            hits = sum(len(l[0]) for l in locations)
+        if scale_memo.collapsed(family, hits):
+            locations, scale = fit(img, templates, start, stop, threshold, bands=bands, peaks=peaks)
+            hits = sum(len(l[0]) for l in locations)
+        scale_memo.record(family, hits)
     img_locations = []
     for i in range(len(templates)):
         w, h = templates[i].shape[::-1]
-        w *= scale
-        h *= scale
-        img_locations.append([Rectangle(pt[0], pt[1], w, h) for pt in zip(*locations[i][::-1])])
-    return img_locations
+        ys, xs, scores = locations[i]
+        img_locations.append(Detections(xs, ys, w * scale, h * scale, scores, np.full(len(xs), i)))
+    return Detections.concat(img_locations)
 
 def merge_recs(recs, threshold):
-    filtered_recs = []
-    while len(recs) > 0:
-        r = recs.pop(0)
-        recs.sort(key=lambda rec: rec.distance(r))
-        merged = True
-        while(merged):
-            merged = False
-            i = 0
-            for _ in range(len(recs)):
-                if r.overlap(recs[i]) > threshold or recs[i].overlap(r) > threshold:
-                    r = r.merge(recs.pop(i))
-                    merged = True
-                elif recs[i].distance(r) > r.w/2 + recs[i].w/2:
-                    break
-                else:
-                    i += 1
-        filtered_recs.append(r)
-    return filtered_recs
+    boxes = np.array([(r.x, r.y, r.w, r.h) for r in recs], dtype=np.float64).reshape(-1, 4)
+    merged, labels = merge_boxes(boxes, threshold)
+    return [Rectangle(*box) for box in merged.tolist()]
 
 def open_file(path):
     cmd = {'linux':'eog', 'win32':'explorer', 'darwin':'open'}[sys.platform]
     subprocess.run([cmd, path])
 
-def imgs2midi(images, result_dir):
-    note_groups = []
-    for img_idx, img in enumerate(images):
-        img = img.resize((2479, 3508))
+def prepare_page(img):
+    # grayscale pages come straight from convert_pdf_to_images, other images
+    # (PIL) take the resize and colour conversion path
+    if isinstance(img, np.ndarray) and img.ndim == 2:
+        img_gray = img
+        if img_gray.shape != (page_height, page_width):
+            img_gray = cv2.resize(img_gray, (page_width, page_height), interpolation = cv2.INTER_AREA)
+    else:
+        img = img.resize((page_width, page_height))
         img = np.array(img)
         img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        img = cv2.cvtColor(img_gray,cv2.COLOR_GRAY2RGB)
-        ret,img_gray = cv2.threshold(img_gray,127,255,cv2.THRESH_BINARY)
-        img_width, img_height = img_gray.shape[::-1]
-
-        staff_recs = locate_images(img_gray, staff_imgs, staff_lower, staff_upper, staff_thresh)
-
-        staff_recs = [j for i in staff_recs for j in i]
-        heights = [r.y for r in staff_recs] + [0]
-        histo = [heights.count(i) for i in range(0, max(heights) + 1)]
-        avg = np.mean(list(set(histo)))
-        staff_recs = [r for r in staff_recs if histo[r.y] > avg]
-
-        staff_recs = merge_recs(staff_recs, 0.01)
-        # staff_recs_img = img.copy()
-        # for r in staff_recs:
-            # r.draw(staff_recs_img, (0, 0, 255), 2)
-        # cv2.imwrite(f'{result_dir}/{img_idx}/staff_recs_img.png', staff_recs_img)
-
-        staff_boxes = merge_recs([Rectangle(0, r.y, img_width, r.h) for r in staff_recs], 0.01)
-        # staff_boxes_img = img.copy()
-        # for r in staff_boxes:
-            # r.draw(staff_boxes_img, (0, 0, 255), 2)
-        # cv2.imwrite(f'{result_dir}/{img_idx}/staff_boxes_img.png', staff_boxes_img)
-        
-        sharp_recs = locate_images(img_gray, sharp_imgs, sharp_lower, sharp_upper, sharp_thresh)
-
-        sharp_recs = merge_recs([j for i in sharp_recs for j in i], 0.5)
-        # sharp_recs_img = img.copy()
-        # for r in sharp_recs:
-            # r.draw(sharp_recs_img, (0, 0, 255), 2)
-        # cv2.imwrite(f'{result_dir}/{img_idx}/sharp_recs_img.png', sharp_recs_img)
-
-        flat_recs = locate_images(img_gray, flat_imgs, flat_lower, flat_upper, flat_thresh)
-
-        flat_recs = merge_recs([j for i in flat_recs for j in i], 0.5)
-        # flat_recs_img = img.copy()
-        # for r in flat_recs:
-            # r.draw(flat_recs_img, (0, 0, 255), 2)
-        # cv2.imwrite(f'{result_dir}/{img_idx}/flat_recs_img.png', flat_recs_img)
-
-        quarter_recs = locate_images(img_gray, quarter_imgs, quarter_lower, quarter_upper, quarter_thresh)
-
-        quarter_recs = merge_recs([j for i in quarter_recs for j in i], 0.5)
-        # quarter_recs_img = img.copy()
-        # for r in quarter_recs:
-            # r.draw(quarter_recs_img, (0, 0, 255), 2)
-        # cv2.imwrite(f'{result_dir}/{img_idx}/quarter_recs_img.png', quarter_recs_img)
-
-        half_recs = locate_images(img_gray, half_imgs, half_lower, half_upper, half_thresh)
-
-        half_recs = merge_recs([j for i in half_recs for j in i], 0.5)
-        # half_recs_img = img.copy()
-        # for r in half_recs:
-            # r.draw(half_recs_img, (0, 0, 255), 2)
-        # cv2.imwrite(f'{result_dir}/{img_idx}/half_recs_img.png', half_recs_img)
-
-        whole_recs = locate_images(img_gray, whole_imgs, whole_lower, whole_upper, whole_thresh)
-
-        whole_recs = merge_recs([j for i in whole_recs for j in i], 0.5)
-        # whole_recs_img = img.copy()
-        # for r in whole_recs:
-            # r.draw(whole_recs_img, (0, 0, 255), 2)
-        # cv2.imwrite(f'{result_dir}/{img_idx}/whole_recs_img.png', whole_recs_img)
-
-        for box in staff_boxes:
-            staff_sharps = [Note(r, "sharp", box) 
-                for r in sharp_recs if abs(r.middle[1] - box.middle[1]) < box.h*5.0/7.0]
-            staff_flats = [Note(r, "flat", box) 
-                for r in flat_recs if abs(r.middle[1] - box.middle[1]) < box.h*5.0/7.0]
-            quarter_notes = [Note(r, "4,8", box, staff_sharps, staff_flats) 
-                for r in quarter_recs if abs(r.middle[1] - box.middle[1]) < box.h*5.0/7.0]
-            half_notes = [Note(r, "2", box, staff_sharps, staff_flats) 
-                for r in half_recs if abs(r.middle[1] - box.middle[1]) < box.h*5.0/7.0]
-            whole_notes = [Note(r, "1", box, staff_sharps, staff_flats) 
-                for r in whole_recs if abs(r.middle[1] - box.middle[1]) < box.h*5.0/7.0]
-            staff_notes = quarter_notes + half_notes + whole_notes
-            staff_notes.sort(key=lambda n: n.rec.x)
-            staffs = [r for r in staff_recs if r.overlap(box) > 0]
-            staffs.sort(key=lambda r: r.x)
-            # note_color = (randint(0, 255), randint(0, 255), randint(0, 255))
-            note_group = []
-            i = 0; j = 0
-            while(i < len(staff_notes)):
-                if (j < len(staffs) and staff_notes[i].rec.x > staffs[j].x):
-                    r = staffs[j]
-                    j += 1
-                    if len(note_group) > 0:
-                        note_groups.append(note_group)
-                        note_group = []
-                    # note_color = (randint(0, 255), randint(0, 255), randint(0, 255))
-                else:
-                    note_group.append(staff_notes[i])
-                    # staff_notes[i].rec.draw(img, note_color, 2)
-                    i += 1
-            note_groups.append(note_group)
-
-        # for r in staff_boxes:
-            # r.draw(img, (0, 0, 255), 2)
-        # for r in sharp_recs:
-            # r.draw(img, (0, 0, 255), 2)
-        # flat_recs_img = img.copy()
-        # for r in flat_recs:
-            # r.draw(img, (0, 0, 255), 2)
-
-        # cv2.imwrite('res.png', img)
-    
-        # for note_group in note_groups:
-        #     print([ note.note + " " + note.sym for note in note_group])
-
+    ret,img_gray = cv2.threshold(img_gray,127,255,cv2.THRESH_BINARY)
+    return img_gray
+
+def find_staffs_template(img_gray, scale_memo=None):
+    img_width, img_height = img_gray.shape[::-1]
+
+    # the row histogram below counts raw hits, so staffs keep every hit pixel
+    staff_recs = locate_images(img_gray, staff_imgs, staff_lower, staff_upper, staff_thresh,
+        scale_memo, "staff", peaks=False)
+
+    heights = staff_recs.y.astype(np.int64)
+    histo = np.bincount(np.append(heights, 0))
+    avg = np.mean(np.unique(histo))
+    staff_recs = staff_recs.select(histo[heights] > avg)
+
+    staff_recs = staff_recs.merge(0.01)
+    # staff_recs_img = img.copy()
+    # for r in staff_recs:
+        # r.draw(staff_recs_img, (0, 0, 255), 2)
+    # cv2.imwrite(f'{result_dir}/{img_idx}/staff_recs_img.png', staff_recs_img)
+
+    staff_boxes = Detections(np.zeros(len(staff_recs)), staff_recs.y, img_width, staff_recs.h).merge(0.01)
+    # staff_boxes_img = img.copy()
+    # for r in staff_boxes:
+        # r.draw(staff_boxes_img, (0, 0, 255), 2)
+    # cv2.imwrite(f'{result_dir}/{img_idx}/staff_boxes_img.png', staff_boxes_img)
+    return staff_recs, staff_boxes
+
+def find_staffs_profile(img_gray, scale_memo=None):
+    staff_recs, staff_boxes = find_staffs(img_gray)
+    staff_recs, staff_boxes = Detections.from_recs(staff_recs), Detections.from_recs(staff_boxes)
+    if scale_memo is not None and len(staff_boxes):
+        # seed the memo with the staff template scale, snapped to the sweep grid
+        scale = np.median(staff_boxes.h) / max(img.shape[0] for img in staff_imgs)
+        percent = staff_lower + 3 * int(round((scale * 100 - staff_lower) / 3.0))
+        scale_memo.seed(min(max(percent, staff_lower), staff_upper) / 100.0)
+    return staff_recs, staff_boxes
+
+staff_detectors = {
+    "template": find_staffs_template,
+    "profile": find_staffs_profile}
+
+def detect_page(img, scale_memo=None, staff_detector="template"):
+    note_groups = []
+    img_gray = prepare_page(img)
+
+    staff_recs, staff_boxes = staff_detectors[staff_detector](img_gray, scale_memo)
+    staff_boxes = staff_boxes.to_recs()
+
+    # symbols are only kept near a staff, so only match inside those bands
+    bands = [(box.middle[1] - box.h*5.0/7.0, box.middle[1] + box.h*5.0/7.0) for box in staff_boxes]
+
+    sharp_recs = locate_images(img_gray, sharp_imgs, sharp_lower, sharp_upper, sharp_thresh,
+        scale_memo, "sharp", bands)
+
+    sharp_recs = sharp_recs.merge(0.5)
+    # sharp_recs_img = img.copy()
+    # for r in sharp_recs:
+        # r.draw(sharp_recs_img, (0, 0, 255), 2)
+    # cv2.imwrite(f'{result_dir}/{img_idx}/sharp_recs_img.png', sharp_recs_img)
+
+    flat_recs = locate_images(img_gray, flat_imgs, flat_lower, flat_upper, flat_thresh,
+        scale_memo, "flat", bands)
+
+    flat_recs = flat_recs.merge(0.5)
+    # flat_recs_img = img.copy()
+    # for r in flat_recs:
+        # r.draw(flat_recs_img, (0, 0, 255), 2)
+    # cv2.imwrite(f'{result_dir}/{img_idx}/flat_recs_img.png', flat_recs_img)
+
+    quarter_recs = locate_images(img_gray, quarter_imgs, quarter_lower, quarter_upper, quarter_thresh,
+        scale_memo, "quarter", bands)
+
+    quarter_recs = quarter_recs.merge(0.5)
+    # quarter_recs_img = img.copy()
+    # for r in quarter_recs:
+        # r.draw(quarter_recs_img, (0, 0, 255), 2)
+    # cv2.imwrite(f'{result_dir}/{img_idx}/quarter_recs_img.png', quarter_recs_img)
+
+    half_recs = locate_images(img_gray, half_imgs, half_lower, half_upper, half_thresh,
+        scale_memo, "half", bands)
+
+    half_recs = half_recs.merge(0.5)
+    # half_recs_img = img.copy()
+    # for r in half_recs:
+        # r.draw(half_recs_img, (0, 0, 255), 2)
+    # cv2.imwrite(f'{result_dir}/{img_idx}/half_recs_img.png', half_recs_img)
+
+    whole_recs = locate_images(img_gray, whole_imgs, whole_lower, whole_upper, whole_thresh,
+        scale_memo, "whole", bands)
+
+    whole_recs = whole_recs.merge(0.5)
+    # whole_recs_img = img.copy()
+    # for r in whole_recs:
+        # r.draw(whole_recs_img, (0, 0, 255), 2)
+    # cv2.imwrite(f'{result_dir}/{img_idx}/whole_recs_img.png', whole_recs_img)
+
+    for box in staff_boxes:
+        staff_sharps = [Note(r, "sharp", box) 
+            for r in sharp_recs.select(sharp_recs.near(box)).to_recs()]
+        staff_flats = [Note(r, "flat", box) 
+            for r in flat_recs.select(flat_recs.near(box)).to_recs()]
+        quarter_notes = [Note(r, "4,8", box, staff_sharps, staff_flats) 
+            for r in quarter_recs.select(quarter_recs.near(box)).to_recs()]
+        half_notes = [Note(r, "2", box, staff_sharps, staff_flats) 
+            for r in half_recs.select(half_recs.near(box)).to_recs()]
+        whole_notes = [Note(r, "1", box, staff_sharps, staff_flats) 
+            for r in whole_recs.select(whole_recs.near(box)).to_recs()]
+        staff_notes = quarter_notes + half_notes + whole_notes
+        staff_notes.sort(key=lambda n: n.rec.x)
+        staffs = np.sort(staff_recs.x[staff_recs.overlapping(box)])
+        # note_color = (randint(0, 255), randint(0, 255), randint(0, 255))
+        note_group = []
+        i = 0; j = 0
+        while(i < len(staff_notes)):
+            if (j < len(staffs) and staff_notes[i].rec.x > staffs[j]):
+                j += 1
+                if len(note_group) > 0:
+                    note_groups.append(note_group)
+                    note_group = []
+                # note_color = (randint(0, 255), randint(0, 255), randint(0, 255))
+            else:
+                note_group.append(staff_notes[i])
+                # staff_notes[i].rec.draw(img, note_color, 2)
+                i += 1
+        note_groups.append(note_group)
+
+    # for r in staff_boxes:
+        # r.draw(img, (0, 0, 255), 2)
+    # for r in sharp_recs:
+        # r.draw(img, (0, 0, 255), 2)
+    # flat_recs_img = img.copy()
+    # for r in flat_recs:
+        # r.draw(img, (0, 0, 255), 2)
+
+    # cv2.imwrite('res.png', img)
+
+    # for note_group in note_groups:
+    #     print([ note.note + " " + note.sym for note in note_group])
+
+    return note_groups
+
+def _init_worker(templates):
+    globals().update(templates)
+    warm_templates()
+
+def _detect_page_task(args):
+    return detect_page(*args)
+
+def detect_page_with_memo(img, scale_memo, staff_detector="template"):
+    # for executors that return results by value: hands the updated memo back
+    return detect_page(img, scale_memo, staff_detector), scale_memo
+
+def get_pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.close()
+        templates = {
+            "staff_imgs": staff_imgs, "quarter_imgs": quarter_imgs, "sharp_imgs": sharp_imgs,
+            "flat_imgs": flat_imgs, "half_imgs": half_imgs, "whole_imgs": whole_imgs}
+        _pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(templates,))
+        _pool_workers = workers
+    return _pool
+
+def detect_pages(count, detect, detect_rest=None):
+    """
+    Note groups of `count` pages in page order. Pages go one by one through
+    detect(i, scale_memo) -> (groups, scale_memo) until one of them seeds
+    the scale memo; with detect_rest the remaining pages then share the
+    frozen memo and go through detect_rest(indices, scale_memo) -> groups
+    per page, so they give what the serial loop would have given.
+    """
+    scale_memo = ScaleMemo()
+    page_groups = []
+    i = 0
+    while i < count and not (scale_memo.frozen and detect_rest is not None):
+        groups, scale_memo = detect(i, scale_memo)
+        scale_memo.freeze()
+        page_groups.append(groups)
+        i += 1
+    if i < count:
+        page_groups += list(detect_rest(list(range(i, count)), scale_memo))
+    return [group for groups in page_groups for group in groups]
+
+def imgs2midi(images, result_dir, workers=None, staff_detector="template"):
+    if workers is None:
+        workers = omr_workers
+    images = list(images)
+
+    def detect(i, scale_memo):
+        return detect_page_with_memo(images[i], scale_memo, staff_detector)
+
+    def detect_rest(indices, scale_memo):
+        pool = get_pool(workers)
+        return pool.map(_detect_page_task, [(images[i], scale_memo, staff_detector) for i in indices])
+
+    note_groups = detect_pages(len(images), detect, detect_rest if workers > 1 else None)
+    return write_midi(note_groups, result_dir)
+
+def write_midi(note_groups, result_dir):
     midi = MIDIFile(1)
     
     track = 0   
@@ -230,14 +377,19 @@ def imgs2midi(images, result_dir):
     midi.writeFile(binfile)
     binfile.close()
     
-    return file_to_bytes(os.path.join(result_dir, "imgs2midi.mid"))
+    return read_bytes(os.path.join(result_dir, "imgs2midi.mid"))
+
+def convert_pdf(job_dir, workers=None, staff_detector="template"):
+    # convert_it.pdf in job_dir -> MIDI bytes, in one call so a process pool
+    # worker renders and matches without shipping page buffers around
+    return imgs2midi(convert_pdf_to_images(job_dir), job_dir, workers, staff_detector)
 
 if __name__ == "__main__":
     from PIL import Image
     import fitz
     import pretty_midi
 
-    def convert_pdf_to_images(pdf_path, image_format='png', dpi=300):
+    def save_pdf_images(pdf_path, image_format='png', dpi=300):
         document = fitz.open(pdf_path)
         
         images = []
@@ -259,7 +411,7 @@ if __name__ == "__main__":
     result_dir = f"results/{name}"
     os.makedirs(result_dir, exist_ok=True)
     
-    images = convert_pdf_to_images(pdf_path)
+    images = save_pdf_images(pdf_path)
     midis = imgs2midi(images, result_dir)
     midi_data = pretty_midi.PrettyMIDI(os.path.join(result_dir, "imgs2midi.mid"))
     print(midi_data)
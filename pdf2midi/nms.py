@@ -0,0 +1,217 @@
+import math
+
+import numpy as np
+
+# boxes scanned at a time when looking for the next one to merge
+scan_block = 16
+scan_block_max = 4096
+# boxes the first ring around a seed is sized to hold on average
+first_ring = 128
+
+class DistanceOrder:
+    """
+    Alive boxes in the order merge_recs keeps its list in once it has sorted
+    it by the distance to `seed` (a stable sort, so ties keep the order the
+    earlier seeds gave them, and in the end the input order). Boxes are
+    pulled in ring by ring from a grid of their middles, so only the part
+    of the order that is looked at gets sorted.
+    """
+    def __init__(self, grid, seed, seeds, alive):
+        self.grid = grid
+        self.seeds = seeds
+        self.alive = alive
+        self.mx, self.my = grid.mx[seed], grid.my[seed]
+        self.radius = -1.0
+        self.reach = grid.reach(self.mx, self.my)
+        self.items = np.zeros(0, dtype=np.int64)
+
+    @property
+    def done(self):
+        return self.radius >= self.reach
+
+    def distance(self, idx, mx, my):
+        dx = self.grid.mx[idx] - mx
+        dy = self.grid.my[idx] - my
+        return np.sqrt(dx*dx + dy*dy)
+
+    def extend(self):
+        inner = self.radius
+        self.radius = max(2 * self.radius, self.grid.start)
+        if 2 * self.radius >= self.reach:
+            self.radius = self.reach
+        if self.done:
+            # the last ring takes everything left, whatever rounding says
+            idx = np.flatnonzero(self.alive)
+        else:
+            idx = self.grid.query(self.mx, self.my, self.radius)
+            idx = idx[self.alive[idx]]
+        d = self.distance(idx, self.mx, self.my)
+        ring = (d > inner) & ((d <= self.radius) | self.done)
+        self.items = np.concatenate([self.items, self.sort(idx[ring], d[ring])])
+
+    def sort(self, idx, d):
+        # by distance, ties by the distances to the earlier seeds (latest
+        # first), then by input order
+        order = np.lexsort((idx, d))
+        idx, d = idx[order], d[order]
+        same = d[1:] == d[:-1]
+        if len(self.seeds) < 2 or not same.any():
+            return idx
+        rank = np.cumsum(np.concatenate(([True], ~same)))
+        tied = np.concatenate((same, [False])) | np.concatenate(([False], same))
+        positions = np.flatnonzero(tied)
+        tied_idx, tied_rank = idx[positions], rank[positions]
+        # boxes sharing a middle tie at every seed, so each middle is ranked once
+        keys, inverse = np.unique(np.column_stack((tied_rank, self.grid.mx[tied_idx], self.grid.my[tied_idx])),
+            axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        key_rank = keys[:, 0].astype(np.int64)
+        key_ids = np.arange(len(keys))
+        for mx, my in reversed(self.seeds[:-1]):
+            if np.count_nonzero(key_rank[1:] != key_rank[:-1]) + 1 == len(keys):
+                break
+            dx = keys[key_ids, 1] - mx
+            dy = keys[key_ids, 2] - my
+            key_d = np.sqrt(dx*dx + dy*dy)
+            order = np.lexsort((key_d, key_rank))
+            key_ids, key_d, key_rank = key_ids[order], key_d[order], key_rank[order]
+            key_rank = key_rank[0] + np.cumsum(np.concatenate(([False],
+                (key_rank[1:] != key_rank[:-1]) | (key_d[1:] != key_d[:-1]))))
+        final = np.empty(len(keys), dtype=np.int64)
+        final[key_ids] = key_rank
+        idx[positions] = tied_idx[np.lexsort((tied_idx, final[inverse]))]
+        return idx
+
+    def block(self, start, size):
+        # positions (into items) and ids of up to size alive boxes from start on
+        while True:
+            while start >= len(self.items) and not self.done:
+                self.extend()
+            positions = np.arange(start, min(start + size, len(self.items)))
+            positions = positions[self.alive[self.items[positions]]]
+            if len(positions) or start + size >= len(self.items) and self.done:
+                return positions, self.items[positions]
+            start += size
+
+class Grid:
+    # box middles bucketed into square cells, row by row
+    def __init__(self, mx, my, cell):
+        self.mx, self.my = mx, my
+        self.cell = cell
+        self.x0, self.y0 = mx.min(), my.min()
+        self.x1, self.y1 = mx.max(), my.max()
+        col = ((mx - self.x0) // cell).astype(np.int64)
+        row = ((my - self.y0) // cell).astype(np.int64)
+        self.cols = int(col.max()) + 1
+        self.rows = int(row.max()) + 1
+        key = row * self.cols + col
+        self.order = np.argsort(key, kind="stable")
+        self.keys = key[self.order]
+        # radius of a disc holding first_ring middles at the mean density
+        extent = (self.x1 - self.x0 + cell) * (self.y1 - self.y0 + cell)
+        self.start = max(cell, math.sqrt(first_ring * extent / (math.pi * len(mx))))
+
+    def reach(self, mx, my):
+        # distance from (mx, my) to the farthest middle there can be
+        dx = max(mx - self.x0, self.x1 - mx)
+        dy = max(my - self.y0, self.y1 - my)
+        return float(np.sqrt(dx*dx + dy*dy))
+
+    def query(self, mx, my, radius):
+        # every box whose middle may lie within radius of (mx, my)
+        c0 = max(0, int((mx - radius - self.x0) // self.cell))
+        c1 = min(self.cols - 1, int((mx + radius - self.x0) // self.cell))
+        r0 = max(0, int((my - radius - self.y0) // self.cell))
+        r1 = min(self.rows - 1, int((my + radius - self.y0) // self.cell))
+        if c1 < c0 or r1 < r0:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.arange(r0, r1 + 1) * self.cols
+        lo = np.searchsorted(self.keys, rows + c0, "left")
+        hi = np.searchsorted(self.keys, rows + c1, "right")
+        return np.concatenate([self.order[a:b] for a, b in zip(lo, hi)])
+
+def merge_boxes(boxes, threshold):
+    """
+    Merge overlapping boxes the way merge_recs did: the first box left is a
+    seed, the others are sorted by distance to it, and going down that list
+    the seed absorbs every box it covers more than `threshold` of or that
+    covers more than `threshold` of it (see Rectangle.overlap), measured
+    against the seed as grown so far; the walk stops at the first box that
+    neither overlaps nor lies within half their widths of the grown seed,
+    and starts over from the top while anything was merged.
+    :param boxes: (n, 4) array of x, y, w, h
+    :param threshold: overlap ratio above which two boxes are merged
+    :return: (m, 4) array of merged boxes and, for every input box, the index
+        of the merged box it ended up in
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    n = len(boxes)
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return boxes.copy(), labels
+
+    x, y, w, h = boxes.T
+    right, bottom, area = x + w, y + h, w * h
+    grid = Grid(x + w/2, y + h/2, max(w.max(), h.max(), 1.0))
+    xs, ys, ws, rights, bottoms, areas = x.tolist(), y.tolist(), w.tolist(), right.tolist(), bottom.tolist(), area.tolist()
+    mxs, mys = grid.mx.tolist(), grid.my.tolist()
+    alive = np.ones(n, dtype=bool)
+    seeds = []
+    merged = []
+    seed = 0
+    while True:
+        label = len(merged)
+        labels[seed] = label
+        alive[seed] = False
+        seeds.append((grid.mx[seed], grid.my[seed]))
+        order = DistanceOrder(grid, seed, seeds, alive)
+        bx, by, bw, bh = boxes[seed].tolist()
+        grown = True
+        while grown:
+            grown = False
+            start, size = 0, scan_block
+            stop = False
+            while True:
+                positions, idx = order.block(start, size)
+                if len(idx) == 0:
+                    break
+                ox = np.maximum(0, np.minimum(bx + bw, right[idx]) - np.maximum(bx, x[idx]))
+                oy = np.maximum(0, np.minimum(by + bh, bottom[idx]) - np.maximum(by, y[idx]))
+                inter = ox * oy
+                hit = (inter / (bw * bh) > threshold) | (inter / area[idx] > threshold)
+                dx = grid.mx[idx] - (bx + bw/2)
+                dy = grid.my[idx] - (by + bh/2)
+                far = np.sqrt(dx*dx + dy*dy) > bw/2 + w[idx]/2
+                event = np.flatnonzero(hit | far)
+                if len(event) == 0:
+                    start, size = positions[-1] + 1, min(2 * size, scan_block_max)
+                    continue
+                k = event[0]
+                if not hit[k]:
+                    break
+                # merge one box at a time while they keep overlapping the grown box
+                for p, i in zip(positions[k:].tolist(), idx[k:].tolist()):
+                    ox = max(0, min(bx + bw, rights[i]) - max(bx, xs[i]))
+                    oy = max(0, min(by + bh, bottoms[i]) - max(by, ys[i]))
+                    inter = ox * oy
+                    if inter / (bw * bh) > threshold or inter / areas[i] > threshold:
+                        x0, y0 = min(bx, xs[i]), min(by, ys[i])
+                        bx, by, bw, bh = x0, y0, max(bx + bw, rights[i]) - x0, max(by + bh, bottoms[i]) - y0
+                        labels[i] = label
+                        alive[i] = False
+                        grown = True
+                        continue
+                    dx = mxs[i] - (bx + bw/2)
+                    dy = mys[i] - (by + bh/2)
+                    if math.sqrt(dx*dx + dy*dy) > bw/2 + ws[i]/2:
+                        stop = True
+                    break
+                if stop:
+                    break
+                start, size = p + 1, scan_block
+        merged.append((bx, by, bw, bh))
+        positions, idx = order.block(0, 1)
+        if len(idx) == 0:
+            break
+        seed = idx[0]
+    return np.array(merged, dtype=np.float64), labels
@@ -0,0 +1,43 @@
+class ScaleMemo(object):
+    """
+    Engraving scale shared by all pages and symbol families of one document.
+    The first staff match seeds the scale; every later search only tries
+    `window_steps` scale steps on either side of it, and falls back to the
+    full sweep when its hit count collapses (or, on the seeding page, when a
+    family has no hits in the window yet).
+    """
+    def __init__(self, window_steps=2, step=3, collapse_ratio=0.25):
+        self.window_steps = window_steps
+        self.step = step
+        self.collapse_ratio = collapse_ratio
+        self.scale = None
+        self.hits = {}
+        self.frozen = False
+
+    def seed(self, scale):
+        if self.scale is None and not self.frozen:
+            self.scale = scale
+
+    def freeze(self):
+        # called after the page that seeded the scale, from then on the memo
+        # is the same for every later page no matter in which order they run
+        if self.scale is not None:
+            self.frozen = True
+
+    def scales(self, start_percent, stop_percent):
+        percent = int(round(self.scale * 100))
+        return [(percent + i*self.step)/100.0
+            for i in range(-self.window_steps, self.window_steps + 1)
+            if start_percent <= percent + i*self.step <= stop_percent]
+
+    def collapsed(self, family, hits):
+        if family not in self.hits:
+            # no full sweep has found this family yet: on the seeding page
+            # zero hits may just mean its scale lies outside the window, on
+            # later pages it is taken as absent from the page
+            return hits == 0 and not self.frozen
+        return hits < self.hits[family] * self.collapse_ratio
+
+    def record(self, family, hits):
+        if family not in self.hits and hits > 0 and not self.frozen:
+            self.hits[family] = hits
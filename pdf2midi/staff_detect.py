@@ -0,0 +1,172 @@
+import difflib
+import numpy as np
+from pdf2midi.rectangle import Rectangle
+
+# the template path boxes a staff with a staff*.png hit: centred on the
+# staff and about 2.06 times the distance between top and bottom line
+box_ratio = 2.06
+
+line_fill = 0.4          # minimal share of dark pixels in a staff line row
+line_run = 0.25          # minimal longest dark run in a staff line row, as share of the width
+line_pad = 1             # rows next to a staff line that may be dark with it
+clean_noise = 0.2        # dark pixels off the lines a bare column may still have
+                         # (a slur or beam crossing the staff), as share of the line spacing
+lines_per_staff = 5
+
+def longest_run(row):
+    padded = np.concatenate(([0], row.view(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(padded))
+    if len(edges) == 0:
+        return 0
+    return int((edges[1::2] - edges[::2]).max())
+
+def find_lines(dark):
+    """
+    :return: (first, last) row of every staff line, top to bottom
+    """
+    img_height, img_width = dark.shape
+    rows = np.count_nonzero(dark, axis=1)
+    candidates = np.flatnonzero(rows > img_width * line_fill)
+    candidates = [y for y in candidates if longest_run(dark[y]) > img_width * line_run]
+    # consecutive rows belong to the same (thick) line
+    lines = []
+    for y in candidates:
+        if lines and y - lines[-1][-1] <= 1:
+            lines[-1].append(y)
+        else:
+            lines.append([y])
+    return [(line[0], line[-1]) for line in lines]
+
+def group_lines(lines):
+    """
+    :return: the lines of every staff, lines_per_staff (first, last) rows each
+    """
+    if len(lines) < lines_per_staff:
+        return []
+    middles = [(first + last) / 2.0 for first, last in lines]
+    gaps = np.diff(middles)
+    spacing = np.median(np.sort(gaps)[:max(1, len(gaps) // 2 + 1)])
+    staffs = []
+    group = [lines[0]]
+    for line, gap in zip(lines[1:], gaps):
+        if gap <= spacing * 1.5:
+            group.append(line)
+        else:
+            group = [line]
+        if len(group) == lines_per_staff:
+            staffs.append(group)
+            group = []
+    return staffs
+
+def staff_box(top, bottom, img_width):
+    h = (bottom - top) * box_ratio
+    y = (top + bottom - h) / 2.0
+    return Rectangle(0, int(round(y)), img_width, int(round(h)))
+
+def find_clean_runs(dark, lines, box):
+    """
+    Column spans where the staff is bare: every line is dark and next to
+    nothing else inside the staff box is, which is where the template path's
+    staff*.png templates match. Runs break at every symbol, bar line or stem.
+    :return: one Rectangle per run, as high as the box
+    """
+    spacing = ((lines[-1][0] + lines[-1][1]) - (lines[0][0] + lines[0][1])) / 2.0 / (len(lines) - 1)
+    y0, y1 = max(0, box.y), min(dark.shape[0], box.y + box.h)
+    band = dark[y0:y1]
+    on_line = np.zeros(len(band), dtype=bool)
+    lines_dark = np.ones(dark.shape[1], dtype=bool)
+    for first, last in lines:
+        on_line[max(0, first - line_pad - y0):max(0, last + line_pad + 1 - y0)] = True
+        lines_dark &= band[max(0, first - y0):max(0, last + 1 - y0)].any(axis=0)
+    clean = lines_dark & (np.count_nonzero(band[~on_line], axis=0) <= int(spacing * clean_noise))
+    padded = np.concatenate(([0], clean.view(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(padded))
+    return [Rectangle(int(x0), box.y, int(x1 - x0), box.h)
+        for x0, x1 in zip(edges[::2], edges[1::2])]
+
+def find_staffs(img_gray):
+    """
+    Find staffs from the row projection profile of a binarised page.
+    :param img_gray: binarised page, dark symbols on white
+    :return: (staff_recs, staff_boxes) as produced by the template path:
+        the bare stretches of staff between symbols and one full width box
+        per staff
+    """
+    dark = img_gray < 128
+    img_width = dark.shape[1]
+    staff_recs = []
+    staff_boxes = []
+    for lines in group_lines(find_lines(dark)):
+        top = (lines[0][0] + lines[0][1]) / 2.0
+        bottom = (lines[-1][0] + lines[-1][1]) / 2.0
+        box = staff_box(top, bottom, img_width)
+        staff_boxes.append(box)
+        staff_recs += find_clean_runs(dark, lines, box)
+    return staff_recs, staff_boxes
+
+def coverage(recs, box, width):
+    # columns covered by the recs whose middle lies inside box
+    covered = np.zeros(width, dtype=bool)
+    for r in recs:
+        if box.y <= r.middle[1] < box.y + box.h:
+            covered[max(0, int(r.x)):max(0, int(r.x + r.w))] = True
+    return covered
+
+def compare_staffs(reference, candidate):
+    """
+    Compare the staffs of two detectors, and the note groups detect_page
+    splits at their staff recs (which decide quarter or eighth durations).
+    :param reference: (staff_recs, staff_boxes, note_groups) of the reference detector
+    :param candidate: (staff_recs, staff_boxes, note_groups) of the detector under test
+    :return: dict of box counts, matched boxes and the mean offset of matched
+        boxes, the column overlap (IoU) of the staff recs within the
+        reference boxes, and group counts and groups matched in order
+    """
+    reference_recs, reference_boxes, reference_groups = reference
+    candidate_recs, candidate_boxes, candidate_groups = candidate
+    matched = []
+    for box in reference_boxes:
+        offsets = [abs(c.middle[1] - box.middle[1]) for c in candidate_boxes]
+        if offsets and min(offsets) < box.h / 4.0:
+            matched.append(min(offsets))
+
+    width = int(max([r.x + r.w for r in reference_recs + candidate_recs] + [1]))
+    both = either = 0
+    for box in reference_boxes:
+        ref, cand = coverage(reference_recs, box, width), coverage(candidate_recs, box, width)
+        both += np.count_nonzero(ref & cand)
+        either += np.count_nonzero(ref | cand)
+
+    def group_keys(groups):
+        return [tuple((note.sym, note.pitch) for note in group) for group in groups]
+    matcher = difflib.SequenceMatcher(None, group_keys(reference_groups), group_keys(candidate_groups), autojunk=False)
+    return {
+        "reference": len(reference_boxes),
+        "candidate": len(candidate_boxes),
+        "matched": len(matched),
+        "mean_offset": float(np.mean(matched)) if matched else None,
+        "recs": (len(reference_recs), len(candidate_recs)),
+        "rec_iou": both / float(either) if either else None,
+        "groups": (len(reference_groups), len(candidate_groups)),
+        "matched_groups": sum(block.size for block in matcher.get_matching_blocks())}
+
+if __name__ == "__main__":
+    import glob
+    import time
+    from PIL import Image
+    from pdf2midi.main import prepare_page, find_staffs_template, detect_page
+
+    for path in sorted(glob.glob("pdf2midi/resources/samples/*")):
+        img_gray = prepare_page(Image.open(path).convert("RGB"))
+        t = time.time()
+        template_recs, template_boxes = find_staffs_template(img_gray)
+        template_recs, template_boxes = template_recs.to_recs(), template_boxes.to_recs()
+        template_time = time.time() - t
+        t = time.time()
+        profile_recs, profile_boxes = find_staffs(img_gray)
+        profile_time = time.time() - t
+        result = compare_staffs(
+            (template_recs, template_boxes, detect_page(img_gray, staff_detector="template")),
+            (profile_recs, profile_boxes, detect_page(img_gray, staff_detector="profile")))
+        result["time"] = (round(template_time, 3), round(profile_time, 3))
+        print(path, result)
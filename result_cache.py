@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+result_cache_dir = os.environ.get("RESULT_CACHE_DIR", "result_cache")
+result_cache_bytes = int(os.environ.get("RESULT_CACHE_BYTES", 256 * 1024 * 1024))
+
+def file_digest(filename, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    On-disk cache of conversion results keyed by the hash of the source file
+    and of the parameters it was converted with. Files are evicted least
+    recently used first (by mtime, refreshed on every hit) once the cache
+    grows past `max_bytes`.
+    """
+    def __init__(self, cache_dir=result_cache_dir, max_bytes=result_cache_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source_path, params):
+        params = json.dumps(params, sort_keys=True).encode('utf-8')
+        return hashlib.sha256((file_digest(source_path) + ":").encode('utf-8') + params).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as file:
+                data = file.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        tmp_path = self.path(f"{key}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes}
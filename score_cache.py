@@ -0,0 +1,72 @@
+import os
+import time
+from collections import OrderedDict
+
+from server_utils import SingleFlight
+
+score_cache_ttl = float(os.environ.get("SCORE_CACHE_TTL", 600))
+score_cache_bytes = int(os.environ.get("SCORE_CACHE_BYTES", 64 * 1024 * 1024))
+
+class ScoreCache:
+    """
+    In-process cache of parsed scores keyed by sheet_music_id, shared by all
+    tracking sessions. Entries expire `ttl` seconds after they were loaded and
+    are evicted least recently used first once their arrays take more than
+    `max_bytes`. Concurrent misses on the same id wait for a single load.
+    :param load: async function sheet_music_id -> Score, or None when the
+        score can't be fetched (not cached)
+    """
+    def __init__(self, load, ttl=score_cache_ttl, max_bytes=score_cache_bytes):
+        self.load = load
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, sheet_music_id):
+        entry = self.entries.get(sheet_music_id)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            self.entries.move_to_end(sheet_music_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return await self.flights.do(sheet_music_id, self._load, sheet_music_id)
+
+    async def _load(self, sheet_music_id):
+        score = await self.load(sheet_music_id)
+        if score is not None:
+            self.put(sheet_music_id, score)
+        return score
+
+    def put(self, sheet_music_id, score):
+        self.entries.pop(sheet_music_id, None)
+        self.entries[sheet_music_id] = (time.time(), score)
+        self.evict()
+
+    def nbytes(self):
+        return sum(score.nbytes for _, score in self.entries.values())
+
+    def evict(self):
+        now = time.time()
+        for key in [key for key, (loaded, _) in self.entries.items() if now - loaded >= self.ttl]:
+            del self.entries[key]
+            self.evictions += 1
+        total = self.nbytes()
+        # the newest entry stays even when it alone is over the limit
+        while total > self.max_bytes and len(self.entries) > 1:
+            _, (_, score) = self.entries.popitem(last=False)
+            total -= score.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.nbytes(),
+            "max_bytes": self.max_bytes,
+            "loads": self.flights.stats()}
@@ -1,16 +1,50 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.responses import FileResponse
 import uvicorn
+import asyncio
 
-from pdf2midi.main import imgs2midi
+from pdf2midi.main import convert_pdf, warm_templates, template_cache_report
 from server_utils import *
 from tracking import *
+from jobs import JobQueue, convert_pdf_url
+from result_cache import ResultCache
+from score_cache import ScoreCache
 
+import functools
+import json
 import shutil
+import time
+from collections import deque
 
 app = FastAPI()
 
 manager = ConnectionManager()
+result_cache = ResultCache()
+flights = SingleFlight()
+chunk_latencies = deque(maxlen=1000)
+# template cache footprint per CPU worker, reported once the workers are warm
+template_caches = {}
+job_queue = JobQueue(cache=result_cache)
+
+async def load_score(sheet_music_id):
+    data = await run_io(fetch_midi_bytes, sheetMusicId=sheet_music_id)
+    if data is None:
+        return None
+    return await run_cpu(parse_score, data)
+
+score_cache = ScoreCache(load_score)
+
+@app.on_event("startup")
+async def startup():
+    start_executors(initializers=[warm_templates, warm_models])
+    for pid, info in await warm_cpu_workers(template_cache_report):
+        template_caches[pid] = info
+    await job_queue.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await job_queue.stop()
+    shutdown_executors()
 
 @app.get("/")
 async def root():
@@ -20,50 +54,137 @@ async def root():
 async def favicon():
     return FileResponse("icon/favicon.ico")
 
-@app.post("/midi_to_xml")
-async def midi_to_xml(item: MTXJSONRequest):
+async def convert_midi_url(url):
     tmp_folder = create_unique_folder()
-    download_midi_from_server(tmp_folder, url=item.url)
-    score = converter.parse(os.path.join(tmp_folder, "target.mid"))
-    output_path = os.path.join(tmp_folder, 'output.musicxml')
-    score.write('musicxml', fp=output_path)
-    response = {"musicxml":file_to_bytes(output_path)}
-    shutil.rmtree(tmp_folder)
-    return response
+    try:
+        await run_io(download_midi_from_server, tmp_folder, url=url)
+        output_path = await run_cpu(midi_to_musicxml, tmp_folder)
+        return await run_io(read_bytes, output_path)
+    finally:
+        await run_io(shutil.rmtree, tmp_folder)
+
+@app.post("/midi_to_xml")
+async def midi_to_xml(item: MTXJSONRequest, request: Request):
+    musicxml = await flights.do(("midi_to_xml", item.url), convert_midi_url, item.url)
+    return encode_response(request, musicxml, "musicxml", "output.musicxml", compress=True)
 
 @app.post("/pdf_to_midi")
-async def pdf_to_midi(item: PDFJSONRequest):
-    tmp_folder = create_unique_folder()
-    pdf_images = extract_pdfImg_from_json(item, tmp_folder)
-    midi_bytes = imgs2midi(pdf_images, tmp_folder)
-    response = {"midi": midi_bytes}
-    shutil.rmtree(tmp_folder)
-    return response
+async def pdf_to_midi(item: PDFJSONRequest, request: Request):
+    convert = functools.partial(run_cpu, convert_pdf, staff_detector=item.staff_detector)
+    midi = await flights.do(("pdf_to_midi", item.url, item.staff_detector),
+        convert_pdf_url, item.url, item.staff_detector, convert, result_cache)
+    return encode_response(request, midi, "midi", "imgs2midi.mid")
+
+@app.post("/pdf_to_midi/jobs")
+async def submit_pdf_to_midi(item: PDFJSONRequest):
+    try:
+        job = job_queue.submit(item.url, item.staff_detector)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="job queue is full")
+    return job.info()
+
+@app.get("/pdf_to_midi/jobs/{job_id}")
+async def pdf_to_midi_status(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="unknown job")
+    return job.info()
+
+@app.get("/pdf_to_midi/jobs/{job_id}/midi")
+async def pdf_to_midi_result(job_id: str, request: Request):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="unknown job")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"job is {job.status}")
+    return encode_response(request, job.midi, "midi", "imgs2midi.mid")
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "jobs": job_queue.stats(),
+        "result_cache": await run_io(result_cache.stats),
+        "coalescing": flights.stats(),
+        "template_cache": template_caches,
+        "score_cache": score_cache.stats(),
+        "tracking": {
+            "chunks": len(chunk_latencies),
+            "mean_latency": sum(chunk_latencies) / len(chunk_latencies) if chunk_latencies else None,
+            "max_latency": max(chunk_latencies, default=None)}}
+
+async def close_policy_violation(websocket, reason):
+    # 1008: the session can't go on with what the client sent; close reasons
+    # are limited to 123 bytes
+    await websocket.close(code=1008, reason=reason.encode("utf-8")[:123].decode("utf-8", "ignore"))
 
 @app.websocket("/tracking_progress")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
+    tmp_folder = create_unique_folder()
     try:
-        tmp_folder = create_unique_folder()
         current_progress_time, offset = 0, 0
 
-        meta_data = await websocket.receive_json()
-        sheetMusicId = meta_data['sheet_music_id']
+        try:
+            meta_data = await websocket.receive_json()
+            sheetMusicId = meta_data['sheet_music_id']
+            # optional detection stages, e.g. ["notes"] (default) or ["onsets", "notes"]
+            stages = tracking_stages(meta_data.get('detection', detection_stages))
+            # optional raw PCM binary frames instead of base64 m4a in JSON, e.g.
+            # {"encoding": "pcm_s16le", "sample_rate": 16000, "channels": 1}
+            pcm = pcm_format(**meta_data['audio']) if 'audio' in meta_data else None
+            # "dtw" re-aligns every chunk from scratch, "oltw" follows the
+            # performance note by note and sends a cursor update per note
+            tracker = meta_data.get('tracker', "dtw")
+            if tracker not in ("dtw", "oltw"):
+                raise ValueError(f"unknown tracker {tracker!r}")
+            seconds = float(meta_data.get('window_seconds', window_seconds))
+        except (KeyError, TypeError, ValueError) as e:
+            await close_policy_violation(websocket, f"invalid meta data: {e}")
+            return
 
-        tracking_flag = download_midi_from_server(tmp_folder, sheetMusicId=sheetMusicId)
-        await manager.send_message(str({"tracking_flag":tracking_flag}), websocket)
+        whole_midi = await score_cache.get(sheetMusicId)
+        tracking_flag = whole_midi is not None
+        if whole_midi is None:
+            whole_midi = Score.from_notes([])
+        handshake = {"tracking_flag":tracking_flag}
+        if pcm is not None:
+            handshake["audio"] = pcm
+        await manager.send_message(str(handshake), websocket)
 
-        whole_midi = read_midi(os.path.join(tmp_folder, "target.mid"))
+        follower = OnlineScoreFollower(whole_midi) if tracker == "oltw" else None
         while True:
-            data = await websocket.receive_json()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                # a binary frame is a PCM chunk, an empty one ends the session
+                if pcm is None:
+                    await close_policy_violation(websocket, "binary frames need an audio format in the meta data")
+                    return
+                data = {"is_finished": len(message["bytes"]) == 0}
+                audio, audio_pcm = message["bytes"], pcm
+            else:
+                data = json.loads(message["text"])
+                audio, audio_pcm = None, None
             is_finished = data['is_finished']
             if not is_finished:
-                audio_request = data['recording']
+                if audio is None:
+                    audio = recording_bytes(data['recording'])
+
+                chunk_start = time.perf_counter()
+                if follower is not None:
+                    # notes go to the follower window by window, so cursor
+                    # updates start before the whole chunk is detected
+                    samples = await run_cpu(chunk_samples, tmp_folder, audio, audio_pcm)
+                    for lo, start, stop, hi in sub_windows(len(samples)):
+                        part_midi = await run_cpu(detect_window, tmp_folder, samples[lo:hi], lo, start, stop, stages)
+                        for cursor in follower.push(part_midi):
+                            await manager.send_message(str(cursor), websocket)
+                    chunk_latencies.append(time.perf_counter() - chunk_start)
+                    continue
 
-                bytes_to_wav_file(audio_request, tmp_folder)
-                audio_to_midi(tmp_folder)
-                part_midi = read_midi(os.path.join(tmp_folder, "audio2midi_output.mid"))
-                best_start, best_end, play_time = tracking(whole_midi, part_midi, current_progress_time)
+                best_start, best_end, play_time = await run_cpu(track_chunk, tmp_folder, whole_midi, current_progress_time, stages, audio, audio_pcm, seconds)
+                chunk_latencies.append(time.perf_counter() - chunk_start)
                 
                 response = {
                     "best_start": best_start + offset,
@@ -74,8 +195,10 @@ async def websocket_endpoint(websocket: WebSocket):
                 await manager.send_message(str(response), websocket)
             else: break
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
-    shutil.rmtree(tmp_folder)
+        shutil.rmtree(tmp_folder)
 
 if __name__ == "__main__":
     uvicorn.run(app, host='0.0.0.0', port=80)
\ No newline at end of file
@@ -2,16 +2,86 @@ import io
 import requests
 import base64
 from pydantic import BaseModel
-from fastapi import WebSocket
+from typing import Literal
+from fastapi import WebSocket, Request
+from fastapi.responses import StreamingResponse
 
 import fitz
+import numpy as np
 from music21 import converter
 from PIL import Image
 
+import asyncio
+import functools
 import json
 import os
 import time
 import uuid
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+# I/O 작업(다운로드, 파일)은 스레드 풀, CPU 작업(OMR, madmom, music21)은 프로세스 풀에서 실행
+# CPU_WORKERS=0 이면 CPU 작업도 스레드 풀에서 실행
+io_workers = int(os.environ.get("IO_WORKERS", 8))
+cpu_workers = int(os.environ.get("CPU_WORKERS", os.cpu_count() or 1))
+io_executor = None
+cpu_executor = None
+
+def _init_cpu_worker(initializers):
+    for initializer in initializers:
+        initializer()
+
+def start_executors(initializers=()):
+    global io_executor, cpu_executor
+    if io_executor is None:
+        io_executor = ThreadPoolExecutor(io_workers)
+    if cpu_executor is None and cpu_workers > 0:
+        cpu_executor = ProcessPoolExecutor(cpu_workers,
+            initializer=_init_cpu_worker, initargs=(tuple(initializers),))
+    elif cpu_workers == 0:
+        # CPU 작업이 이 프로세스에서 실행되므로 여기서 준비
+        _init_cpu_worker(initializers)
+
+async def warm_cpu_workers(report=os.getpid):
+    # ProcessPoolExecutor는 작업이 제출될 때 워커를 띄우고 그때 initializer를 실행하므로
+    # 시작 시 워커 수만큼 작업을 한꺼번에 제출해 모든 워커를 미리 준비
+    # report는 각 작업이 실행된 프로세스에서 호출되어 그 결과를 모아 돌려줌
+    start_executors()
+    if cpu_executor is None:
+        return [report()]
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[loop.run_in_executor(cpu_executor, report) for _ in range(cpu_workers)])
+
+def shutdown_executors():
+    global io_executor, cpu_executor
+    for executor in (io_executor, cpu_executor):
+        if executor is not None:
+            executor.shutdown(wait=False)
+    io_executor, cpu_executor = None, None
+
+async def run_io(func, *args, **kwargs):
+    start_executors()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+async def run_cpu(func, *args, **kwargs):
+    start_executors()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor or io_executor, functools.partial(func, *args, **kwargs))
+
+def submit_cpu(func, *args, **kwargs):
+    # 이미 스레드에서 실행 중인 코드용 run_cpu, concurrent.futures.Future를 돌려줌
+    start_executors()
+    if cpu_executor is not None:
+        return cpu_executor.submit(func, *args, **kwargs)
+    # CPU_WORKERS=0 이면 호출한 스레드에서 바로 실행
+    # (스레드 풀 안에서 같은 풀의 작업을 기다리면 풀이 가득 찼을 때 멈춤)
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 def create_unique_folder():
     # 현재 시간과 UUID를 조합하여 폴더 이름 생성
@@ -31,16 +101,16 @@ def download_pdf(url, job_dir):
     except requests.exceptions.RequestException as e:
         print(f"Failed to download PDF: {e}")
 
-def convert_pdf_to_images(job_dir, dpi=300):
+def convert_pdf_to_images(job_dir, size=(2479, 3508)):
     document = fitz.open(os.path.join(job_dir, "convert_it.pdf"))
     
     images = []
     for page_number in range(len(document)):
         page = document.load_page(page_number)  # 페이지 객체 로드
-        pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72)) 
-        image_path = os.path.join(job_dir, f"page_{page_number + 1}.png")
-        pix.save(image_path)  # 이미지 파일로 저장
-        img = Image.open(image_path)
+        # 그레이스케일로 목표 크기에 맞춰 바로 렌더링
+        matrix = fitz.Matrix(size[0] / page.rect.width, size[1] / page.rect.height)
+        pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY, alpha=False)
+        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
         images.append(img)
 
     document.close()
@@ -70,6 +140,12 @@ def extract_pdfImg_from_json(json_data, job_dir):
     pdf_imgs = convert_pdf_to_images(job_dir)
     return pdf_imgs
     
+def midi_to_musicxml(job_dir):
+    score = converter.parse(os.path.join(job_dir, "target.mid"))
+    output_path = os.path.join(job_dir, 'output.musicxml')
+    score.write('musicxml', fp=output_path)
+    return output_path
+
 def file_to_bytes(filename):
     # 파일을 바이너리 모드로 열고 내용을 읽음
     with open(filename, 'rb') as file:
@@ -78,13 +154,50 @@ def file_to_bytes(filename):
     encoded_string = base64.b64encode(file_bytes).decode('utf-8')
     return encoded_string
 
+def read_bytes(filename):
+    with open(filename, 'rb') as file:
+        return file.read()
+
+def iter_chunks(data, chunk_size=65536):
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+def iter_gzip_chunks(data, chunk_size=65536):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip 헤더
+    for chunk in iter_chunks(data, chunk_size):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def wants_binary(request: Request):
+    return "application/octet-stream" in request.headers.get("accept", "")
+
+def encode_response(request: Request, data, key, filename, compress=False):
+    """
+    기존 클라이언트에는 {key: base64} JSON을, Accept: application/octet-stream
+    요청에는 원본 바이트를 스트리밍으로 응답 (compress=True 이고
+    Accept-Encoding: gzip 이면 gzip으로 압축)
+    """
+    if not wants_binary(request):
+        return {key: base64.b64encode(data).decode('utf-8')}
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if compress and "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(iter_gzip_chunks(data), media_type="application/octet-stream", headers=headers)
+    headers["Content-Length"] = str(len(data))
+    return StreamingResponse(iter_chunks(data), media_type="application/octet-stream", headers=headers)
+
+def recording_bytes(file_bytes):
+    return base64.b64decode(file_bytes)
+
 def bytes_to_wav_file(file_bytes, save_dir):
-    decoded_bytes = base64.b64decode(file_bytes)
+    decoded_bytes = recording_bytes(file_bytes)
     with open(os.path.join(save_dir, "part.m4a"), 'wb') as file:
         file.write(decoded_bytes)
 
-def download_midi_from_server(save_dir, **kwargs):
-    # 서버에서 파일을 받아옴
+def fetch_midi_bytes(**kwargs):
+    # 서버에서 파일을 받아옴, 실패하면 None
     if "url" not in kwargs:
         url = f"http://3.36.180.35:8080/api/v1/sheet-musics/midi/{kwargs['sheetMusicId']}"
         response = requests.get(url, verify=False) 
@@ -95,16 +208,54 @@ def download_midi_from_server(save_dir, **kwargs):
         url = kwargs["url"]
         response = requests.get(url, verify=False)
     
-    # 응답을 파일로 저장
     if response.status_code == 200:
+        return response.content
+    return None
+
+def download_midi_from_server(save_dir, **kwargs):
+    content = fetch_midi_bytes(**kwargs)
+    
+    # 응답을 파일로 저장
+    if content is not None:
         with open(os.path.join(save_dir, "target.mid"), 'wb') as file:
-            file.write(response.content)
+            file.write(content)
         return True
     else:
         return False
 
+class SingleFlight:
+    """
+    같은 key의 작업이 이미 진행 중이면 새로 시작하지 않고 그 결과를 함께 기다림
+    """
+    def __init__(self):
+        self.flights = {}
+        self.coalesced = 0
+        self.waiting = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.flights[key] = task
+            task.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            self.coalesced += 1
+        self.waiting += 1
+        try:
+            # 한 요청이 끊겨도 공유 중인 작업은 취소되지 않도록 shield
+            return await asyncio.shield(task)
+        finally:
+            self.waiting -= 1
+
+    def stats(self):
+        return {
+            "in_flight": len(self.flights),
+            "waiting": self.waiting,
+            "coalesced": self.coalesced}
+
 class PDFJSONRequest(BaseModel):
     url: str
+    staff_detector: Literal["template", "profile"] = "template"
 
 class MTXJSONRequest(BaseModel):
     url: str
@@ -1,76 +1,250 @@
-from fastdtw import fastdtw
 import pretty_midi
 from pydub import AudioSegment
 from madmom.features.onsets import OnsetPeakPickingProcessor, RNNOnsetProcessor
 from madmom.features.notes import RNNPianoNoteProcessor, NotePeakPickingProcessor
+from madmom.audio.signal import Signal
+import io
 import os
+import subprocess
+import threading
+import numpy as np
+import time
+
+# RNN processors load their model files when constructed, so every worker
+# builds each of them once and shares it between sessions
+processor_factories = {
+    "onsets": RNNOnsetProcessor,
+    "notes": RNNPianoNoteProcessor}
+_processors = {}
+_processors_lock = threading.Lock()
+
+def get_processor(name):
+    """
+    Return the shared processor `name` and the lock guarding its use.
+    """
+    with _processors_lock:
+        if name not in _processors:
+            _processors[name] = (processor_factories[name](), threading.Lock())
+        return _processors[name]
+
+def run_processor(name, data):
+    processor, lock = get_processor(name)
+    data = model_signal(data)
+    with lock:
+        return processor(data)
+
+# the RNN processors expect 44.1 kHz mono
+model_sample_rate = 44100
+# madmom's STFT divides integer signals by the largest value of their dtype
+# and takes float signals as they are, so int16 samples are scaled the same
+# way here to get the activations of the WAV file path
+int16_max = float(np.iinfo(np.int16).max)
+
+def model_signal(data):
+    """
+    Turn a file name or an integer signal into the float signal in [-1, 1]
+    decode_audio returns. The STFT of a shared processor keeps the window of
+    the first signal it saw, scaled for that signal's dtype, so an int16
+    signal after float ones (or before them) would be off by int16_max.
+    :param data: audio file name or Signal
+    :return: float32 Signal
+    """
+    if not isinstance(data, Signal):
+        data = Signal(data, num_channels=1, sample_rate=model_sample_rate)
+    if np.issubdtype(data.dtype, np.integer):
+        scale = float(np.iinfo(data.dtype).max)
+        data = Signal((np.asarray(data) / scale).astype(np.float32), sample_rate=data.sample_rate)
+    return data
+
+def decode_audio(data, sample_rate=model_sample_rate):
+    """
+    Decode an encoded audio chunk (m4a, wav, ...) in memory.
+    :param data: encoded audio bytes
+    :return: mono float32 madmom Signal in [-1, 1]
+    """
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-v", "error", "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"],
+            input=data, capture_output=True, check=True)
+        samples = np.frombuffer(result.stdout, dtype=np.int16)
+    except (OSError, subprocess.CalledProcessError):
+        samples = np.array([], dtype=np.int16)
+    if len(samples) == 0:
+        # mp4 containers with the index at the end can't be read from a pipe,
+        # pydub goes through a temporary file instead
+        audio = AudioSegment.from_file(io.BytesIO(data))
+        audio = audio.set_channels(1).set_frame_rate(sample_rate).set_sample_width(2)
+        samples = np.array(audio.get_array_of_samples(), dtype=np.int16)
+    return Signal((samples / int16_max).astype(np.float32), sample_rate=sample_rate)
+
+# raw PCM a client may stream instead of encoded chunks, as little endian
+# samples with the channels interleaved
+pcm_encodings = {
+    "pcm_s16le": np.dtype("<i2"),
+    "pcm_f32le": np.dtype("<f4")}
+
+def pcm_format(encoding="pcm_s16le", sample_rate=model_sample_rate, channels=1):
+    """
+    Validate a PCM format a client declared.
+    :return: dict of encoding, sample_rate and channels as decode_pcm takes them
+    """
+    if encoding not in pcm_encodings:
+        raise ValueError(f"unsupported encoding {encoding!r}, expected one of {sorted(pcm_encodings)}")
+    if int(sample_rate) <= 0 or int(channels) <= 0:
+        raise ValueError("sample_rate and channels must be positive")
+    return {"encoding": encoding, "sample_rate": int(sample_rate), "channels": int(channels)}
+
+def decode_pcm(data, encoding="pcm_s16le", sample_rate=model_sample_rate, channels=1):
+    """
+    Turn raw PCM bytes into the signal decode_audio returns: mono, 44.1 kHz,
+    float32 in [-1, 1]. Float PCM is already in that range and only
+    downmixed and resampled.
+    """
+    dtype = pcm_encodings[encoding]
+    frame = dtype.itemsize * channels
+    samples = np.frombuffer(data[:len(data) - len(data) % frame], dtype=dtype)
+    samples = samples.reshape(-1, channels).astype(np.float32).mean(axis=1)
+    if dtype.kind == "i":
+        samples = samples / int16_max
+    if sample_rate != model_sample_rate and len(samples):
+        # linear interpolation onto the 44.1 kHz grid the RNNs were trained on
+        count = int(round(len(samples) * model_sample_rate / sample_rate))
+        samples = np.interp(np.arange(count) / model_sample_rate, np.arange(len(samples)) / sample_rate, samples)
+    return Signal(samples.astype(np.float32), sample_rate=model_sample_rate)
 
 def merge_notes(notes, threshold_time=0.1):
     """
-    Merge close notes into one.
-    :param notes: list of tuples (pitch, onset, duration)
+    Merge close notes into one: a note starting less than threshold_time
+    after the first note of a group joins it, the group takes the pitch of
+    its last note and lasts until the latest end.
+    :param notes: list or (n, 3) array of (pitch, onset, duration)
     :param threshold_time: maximum time difference to merge notes
-    :return: list of merged notes
+    :return: (m, 3) array of merged notes sorted by onset
     """
-    if not notes:
-        return []
+    notes = np.asarray(notes, dtype=np.float64).reshape(-1, 3)
+    if len(notes) == 0:
+        return notes
 
     # Sort notes by onset time
-    notes.sort(key=lambda x: x[1])
-
-    merged_notes = []
-    current_note = list(notes[0])
-    
-    for note in notes[1:]:
-        if note[1] - current_note[1] < threshold_time:
-            # Merge the note
-            current_note[0] = note[0]  # Use the latest pitch
-            current_note[2] = max(current_note[2], note[1] + note[2] - current_note[1])  # Update the duration
-        else:
-            # Append the current note and start a new one
-            merged_notes.append(tuple(current_note))
-            current_note = list(note)
+    notes = notes[np.argsort(notes[:, 1], kind="stable")]
+    onsets = notes[:, 1]
+    n = len(notes)
 
-    # Append the last note
-    merged_notes.append(tuple(current_note))
+    # the first note threshold_time after each note, found by binary search
+    # and settled with the same difference the comparison uses
+    following = np.searchsorted(onsets, onsets + threshold_time, "left")
+    index = np.arange(n)
+    while True:
+        late = following < n
+        late[late] = onsets[following[late]] - onsets[late] < threshold_time
+        early = following > index + 1
+        early[early] = onsets[following[early] - 1] - onsets[early] >= threshold_time
+        if not (late.any() or early.any()):
+            break
+        following = following + late - early
+    # groups chain from the first note, each starting where the last one ended
+    following = following.tolist()
+    group_starts = []
+    i = 0
+    while i < n:
+        group_starts.append(i)
+        i = following[i]
+    group_starts = np.array(group_starts)
+    group_ends = np.append(group_starts[1:], n)
 
+    merged_notes = np.empty((len(group_starts), 3))
+    merged_notes[:, 0] = notes[group_ends - 1, 0]  # Use the latest pitch
+    merged_notes[:, 1] = onsets[group_starts]
+    merged_notes[:, 2] = np.maximum.reduceat(onsets + notes[:, 2], group_starts) - onsets[group_starts]
     return merged_notes
 
-def audio_to_midi(unique_folder, thres=0.9, smooth=0.2):
-    audio_path = os.path.join(unique_folder, "part.m4a")
-    midi_path = os.path.join(unique_folder, "audio2midi_output.mid")
-
-    # Load the audio file and convert to mono
-    audio = AudioSegment.from_file(audio_path).set_channels(1)
-    audio.export(f"{unique_folder}/temp.wav", format="wav")
-    
-    # Use madmom to detect onsets with higher sensitivity
-    onset_processor = RNNOnsetProcessor()
-    onsets = onset_processor(f"{unique_folder}/temp.wav")
-    onset_processor = OnsetPeakPickingProcessor(fps=100, threshold=thres, smooth=smooth)
-    onsets = onset_processor(onsets)
-
-    # Use madmom to detect notes with higher sensitivity
-    note_processor = RNNPianoNoteProcessor()
-    notes = note_processor(f"{unique_folder}/temp.wav")
-    note_processor = NotePeakPickingProcessor(threshold=thres, smooth=smooth)
-    notes = note_processor(notes)
-
-    # Create a list of (pitch, onset, duration)
-    note_list = [(int(note[1]), note[0], 0.5) for note in notes] 
+# stages the tracking path runs by default; "onsets" adds the onset RNN and
+# keeps only notes that line up with a detected onset
+detection_stages = ("notes",)
 
-    # Merge close notes
-    merged_notes = merge_notes(note_list)
+def warm_models(stages=detection_stages):
+    # only the processors of the default stages, a session asking for more
+    # builds the rest on its first chunk
+    for name in stages:
+        get_processor(name)
 
+def tracking_stages(stages):
+    """
+    Check the detection stages a tracking session asked for; tracking works
+    on notes, so the notes stage is required.
+    :return: stages as a tuple
+    """
+    stages = tuple(stages)
+    unknown = set(stages) - set(processor_factories)
+    if unknown:
+        raise ValueError(f"unknown detection stages: {sorted(unknown)}")
+    if "notes" not in stages:
+        raise ValueError("tracking needs the notes stage")
+    return stages
+
+class DetectionPipeline:
+    """
+    Note/onset detection with its stages declared up front; only the RNNs of
+    the requested stages run.
+    :param stages: any of "onsets" and "notes", both fuses them
+    :param fuse_window: max distance (s) between a note and its onset when fused
+    """
+    def __init__(self, stages=detection_stages, thres=0.9, smooth=0.2, fuse_window=0.05):
+        unknown = set(stages) - set(processor_factories)
+        if unknown or not stages:
+            raise ValueError(f"unknown detection stages: {sorted(unknown) or stages}")
+        self.stages = tuple(stages)
+        self.thres = thres
+        self.smooth = smooth
+        self.fuse_window = fuse_window
+
+    def __call__(self, audio):
+        """
+        :param audio: audio file name or Signal
+        :return: dict with "onsets" (array of times) and/or "notes"
+            ((n, 3) array of (pitch, onset, duration)) for the requested stages
+        """
+        result = {}
+        if "onsets" in self.stages:
+            onsets = run_processor("onsets", audio)
+            onset_processor = OnsetPeakPickingProcessor(fps=100, threshold=self.thres, smooth=self.smooth)
+            result["onsets"] = np.asarray(onset_processor(onsets))
+        if "notes" in self.stages:
+            notes = run_processor("notes", audio)
+            note_processor = NotePeakPickingProcessor(threshold=self.thres, smooth=self.smooth)
+            notes = np.asarray(note_processor(notes), dtype=np.float64).reshape(-1, 2)
+            # Create an array of (pitch, onset, duration)
+            result["notes"] = np.column_stack([notes[:, 1], notes[:, 0], np.full(len(notes), 0.5)])
+        if "onsets" in result and "notes" in result:
+            result["notes"] = self.fuse(result["notes"], result["onsets"])
+        return result
+
+    def fuse(self, notes, onsets):
+        # keep the notes an onset confirms, moved onto that onset
+        if len(onsets) == 0 or len(notes) == 0:
+            return notes[:0]
+        times = notes[:, 1]
+        right = np.clip(np.searchsorted(onsets, times), 0, len(onsets) - 1)
+        left = np.maximum(right - 1, 0)
+        nearest = onsets[np.where(np.abs(onsets[left] - times) < np.abs(onsets[right] - times), left, right)]
+        keep = np.abs(nearest - times) <= self.fuse_window
+        fused = notes[keep].copy()
+        fused[:, 1] = nearest[keep]
+        return fused
+
+# write the notes of every chunk to audio2midi_output.mid for debugging
+debug_midi = bool(os.environ.get("TRACKING_DEBUG_MIDI"))
+
+def write_notes_midi(notes, midi_path):
     # Create PrettyMIDI object
     midi = pretty_midi.PrettyMIDI()
     instrument = pretty_midi.Instrument(program=0)
 
     # Convert merged notes to MIDI notes
-    for pitch, onset, duration in merged_notes:
+    for pitch, onset, duration in notes:
         midi_note = pretty_midi.Note(
             velocity=100,  # Set a fixed velocity
-            pitch=pitch,
+            pitch=int(pitch),
             start=onset,
             end=onset + duration  # Use the merged duration
         )
@@ -82,10 +256,52 @@ def audio_to_midi(unique_folder, thres=0.9, smooth=0.2):
     with open(midi_path, "wb") as output_file:
         midi.write(output_file)
 
+def decode_chunk(unique_folder, audio=None, pcm=None):
+    """
+    Decode an audio chunk to a mono signal in memory.
+    :param audio: encoded audio bytes, raw PCM bytes (with pcm) or a decoded
+        Signal, part.m4a in unique_folder if not given
+    :return: Signal at model_sample_rate
+    """
+    if audio is None:
+        with open(os.path.join(unique_folder, "part.m4a"), 'rb') as file:
+            audio = file.read()
+    if pcm is not None:
+        return decode_pcm(audio, **pcm)
+    if isinstance(audio, Signal):
+        return audio
+    return decode_audio(audio)
+
+def audio_to_midi(unique_folder, thres=0.9, smooth=0.2, stages=detection_stages, audio=None, pcm=None, write_midi=debug_midi):
+    """
+    Detect the notes of an audio chunk.
+    :param audio: encoded audio bytes or a decoded Signal, part.m4a in
+        unique_folder if not given
+    :param pcm: format from pcm_format() when audio holds raw PCM bytes
+    :param write_midi: also write the notes to audio2midi_output.mid
+    :return: (n, 3) array of merged (pitch, onset, duration)
+    """
+    if "notes" not in stages:
+        raise ValueError("audio_to_midi needs the notes stage")
+
+    # Decode to a mono signal in memory, shared by all detection stages
+    audio = decode_chunk(unique_folder, audio, pcm)
+
+    # Use madmom to detect notes (and onsets, if requested) with higher sensitivity
+    pipeline = DetectionPipeline(stages, thres, smooth)
+    note_list = pipeline(audio)["notes"]
+
+    # Merge close notes
+    merged_notes = merge_notes(note_list)
+
+    if write_midi:
+        write_notes_midi(merged_notes, os.path.join(unique_folder, "audio2midi_output.mid"))
+    return merged_notes
+
 def read_midi(midi_path):
     """
     Extract pitch and duration from a MIDI file.
-    :param midi_path: Path to the MIDI file
+    :param midi_path: Path to the MIDI file, or a file object
     :return: List of tuples (pitch, duration)
     """
     midi_data = pretty_midi.PrettyMIDI(midi_path)
@@ -99,53 +315,394 @@ def read_midi(midi_path):
 
     return notes
 
-def calculate_dtw_distance(seq1, seq2):
+# seconds of score after the current position a chunk is searched in
+window_seconds = 5.0
+
+class Score:
     """
-    Calculate the DTW distance between two sequences.
-    :param seq1: First sequence
-    :param seq2: Second sequence
-    :return: DTW distance
+    Parsed score as pitch, onset and duration arrays sorted by onset, so the
+    notes around a time are found by binary search.
     """
-    distance, _ = fastdtw(seq1, seq2)
-    return distance
+    def __init__(self, pitches, onsets, durations):
+        order = np.argsort(np.asarray(onsets, dtype=np.float64), kind="stable")
+        self.pitches = np.asarray(pitches, dtype=np.float64)[order]
+        self.onsets = np.asarray(onsets, dtype=np.float64)[order]
+        self.durations = np.asarray(durations, dtype=np.float64)[order]
+
+    @classmethod
+    def from_notes(cls, notes):
+        notes = np.asarray(notes, dtype=np.float64).reshape(-1, 3)
+        return cls(notes[:, 0], notes[:, 1], notes[:, 2])
+
+    def __len__(self):
+        return len(self.onsets)
+
+    @property
+    def index(self):
+        # built on first use; parse_score builds it up front so it is
+        # shared through the score cache and pickled to the workers
+        if getattr(self, "_index", None) is None:
+            self._index = ScoreIndex(self.pitches)
+        return self._index
 
-def find_best_matching_section(whole_midi, part_midi, window_size):
+    @property
+    def nbytes(self):
+        nbytes = self.pitches.nbytes + self.onsets.nbytes + self.durations.nbytes
+        if getattr(self, "_index", None) is not None:
+            nbytes += self._index.keys.nbytes + self._index.positions.nbytes
+        return nbytes
+
+    def notes(self, lo=0, hi=None):
+        """
+        :return: (n, 3) array of (pitch, onset, duration) of notes lo to hi
+        """
+        return np.stack([self.pitches[lo:hi], self.onsets[lo:hi], self.durations[lo:hi]], axis=1)
+
+    def window(self, start_time, seconds=window_seconds):
+        """
+        :return: lo, hi index of the notes with start_time <= onset <= start_time + seconds
+        """
+        lo = int(np.searchsorted(self.onsets, start_time, "left"))
+        hi = int(np.searchsorted(self.onsets, start_time + seconds, "right"))
+        return lo, hi
+
+class ScoreIndex:
     """
-    Find the section in whole_midi that best matches part_midi.
-    :param whole_midi: List of (pitch, duration) for the whole MIDI
-    :param part_midi: List of (pitch, duration) for the part MIDI
-    :param window_size: Size of the sliding window
-    :return: Best start and end positions in the whole MIDI
+    Inverted index of the pitch interval n-grams of a score, so a chunk can be
+    located anywhere in it without aligning against every position.
+    Intervals are transposition free and ignore tempo; the n-grams are coded
+    as integers and kept sorted next to the positions they start at.
+    :param n: intervals per n-gram
     """
-    best_distance = float('inf')
-    best_start = 0
-    best_end = 0
+    max_interval = 24
 
-    for start in range(0, len(whole_midi) - window_size + 1):
-        end = start + window_size
-        window = whole_midi[start:end]
-        distance = calculate_dtw_distance(window, part_midi)
-        if distance < best_distance:
-            best_distance = distance
-            best_start = start
-            best_end = end
+    def __init__(self, pitches, n=3):
+        self.n = n
+        codes = self.codes(pitches)
+        order = np.argsort(codes, kind="stable")
+        self.keys = codes[order]
+        self.positions = order
 
-    return best_start, best_end, best_distance
+    def codes(self, pitches):
+        intervals = np.clip(np.diff(np.asarray(pitches, dtype=np.int64)), -self.max_interval, self.max_interval)
+        intervals += self.max_interval
+        count = len(intervals) - self.n + 1
+        if count <= 0:
+            return np.zeros(0, dtype=np.int64)
+        codes = np.zeros(count, dtype=np.int64)
+        for k in range(self.n):
+            codes = codes * (2 * self.max_interval + 1) + intervals[k:k + count]
+        return codes
 
-def filter_by_start_time(whole_midi, start_time):
-    filtered = []
-    for midi in whole_midi:
-        if midi[1] > start_time + 5:
-            break
-        elif midi[1] >= start_time:
-            filtered.append(midi)
-    return filtered
+    def votes(self, pitches):
+        """
+        :param pitches: pitches of the detected notes in onset order
+        :return: score positions the chunk may start at and the number of its
+            n-grams that agree with each, most votes first
+        """
+        query = self.codes(pitches)
+        lo = np.searchsorted(self.keys, query, "left")
+        hi = np.searchsorted(self.keys, query, "right")
+        counts = hi - lo
+        if counts.sum() == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # every hit of the n-gram at offset k votes for a start k notes earlier
+        hits = np.concatenate([self.positions[a:b] for a, b in zip(lo, hi)])
+        starts = hits - np.repeat(np.arange(len(query)), counts)
+        starts, votes = np.unique(starts, return_counts=True)
+        order = np.argsort(-votes, kind="stable")
+        return starts[order], votes[order]
 
-def tracking(whole_midi, part_midi, start_time):
-    whole_midi = filter_by_start_time(whole_midi, start_time)
+def read_score(midi_path):
+    return Score.from_notes(read_midi(midi_path))
 
-    window_size = len(part_midi)
-    best_start, best_end, best_distance = find_best_matching_section(whole_midi, part_midi, window_size)
-    play_time = whole_midi[best_end][1]
+def parse_score(data):
+    """
+    Parse MIDI bytes into a Score without touching the disk.
+    """
+    score = read_score(io.BytesIO(data))
+    score.index
+    return score
+
+def note_costs(whole, part):
+    """
+    L1 distance between every (pitch, start, duration) of part and of whole.
+    :return: (len(part), len(whole)) array
+    """
+    whole = np.asarray(whole, dtype=np.float64).reshape(-1, 3)
+    part = np.asarray(part, dtype=np.float64).reshape(-1, 3)
+    return np.abs(part[:, None, :] - whole[None, :, :]).sum(axis=2)
+
+def dtw_row(dist, row):
+    """
+    One row of a DTW cost matrix. The horizontal steps
+    D[j] = c[j] + min(a[j], D[j - 1]) unroll into a running minimum over the
+    cumulative row cost, so the row is filled without a Python loop.
+    :param dist: accumulated cost of the previous row
+    :param row: costs of the new row
+    :return: accumulated cost of the new row and, per column, the column of
+        the previous row its best path comes from
+    """
+    columns = np.arange(len(row))
+    # best predecessor from the previous row: diagonal or vertical step
+    diagonal = np.concatenate(([np.inf], dist[:-1]))
+    from_diagonal = diagonal < dist
+    best = np.where(from_diagonal, diagonal, dist)
+    source = np.where(from_diagonal, columns - 1, columns)
+
+    # then any run of horizontal steps: D[j] = C[j] + min_{k<=j}(best[k] - C[k-1])
+    cumulative = np.cumsum(row)
+    entry = best - (cumulative - row)
+    running = np.minimum.accumulate(entry)
+    entered = np.maximum.accumulate(np.where(entry <= running, columns, 0))
+    return cumulative + running, source[entered]
+
+def find_best_matching_section(whole_midi, part_midi):
+    """
+    Find the section in whole_midi that best matches part_midi with
+    subsequence DTW: the match may begin and end at any note of whole_midi.
+    :param whole_midi: List of (pitch, start, duration) for the whole MIDI
+    :param part_midi: List of (pitch, start, duration) for the part MIDI
+    :return: Best start and (exclusive) end positions in the whole MIDI and
+        the DTW distance of that section
+    """
+    if len(whole_midi) == 0 or len(part_midi) == 0:
+        return 0, 0, float('inf')
+
+    costs = note_costs(whole_midi, part_midi)
+
+    # the first part note may match any score note
+    dist = costs[0].copy()
+    starts = np.arange(costs.shape[1])
+    for row in costs[1:]:
+        dist, source = dtw_row(dist, row)
+        starts = starts[source]
+
+    best_end = int(np.argmin(dist))
+    return int(starts[best_end]), best_end + 1, float(dist[best_end])
+
+def filter_by_start_time(whole_midi, start_time, seconds=window_seconds):
+    """
+    :param whole_midi: Score or List of (pitch, start, duration)
+    :return: (n, 3) array of the notes starting in the window after start_time
+    """
+    if not isinstance(whole_midi, Score):
+        whole_midi = Score.from_notes(whole_midi)
+    return whole_midi.notes(*whole_midi.window(start_time, seconds))
+
+def relocate(score, part_midi, lo, hi, top=3, min_votes=2, min_share=0.5):
+    """
+    Look for the chunk outside the window lo:hi, for when the performer
+    jumped. Positions voted for by the score's n-gram index are only taken
+    when at least `min_share` of the chunk's n-grams agree with them and
+    they beat the window's own support clearly; the `top` of them are
+    refined with DTW, the chunk's onsets moved onto the candidate. Chunks
+    of fewer than n + 2 notes (at most one n-gram) are never relocated.
+    :return: start and (exclusive) end of the best section in the score, or
+        None when the window holds up
+    """
+    part = np.asarray(part_midi, dtype=np.float64).reshape(-1, 3)
+    queries = len(part) - score.index.n
+    if queries < 2:
+        return None
+    part = part[np.argsort(part[:, 1], kind="stable")]
+    starts, votes = score.index.votes(part[:, 0])
+    inside = (starts >= lo) & (starts < hi)
+    support = votes[inside].max() if inside.any() else 0
+    needed = max(min_votes, int(np.ceil(min_share * queries)), 2 * support)
+    if len(votes) == 0 or votes[0] < needed:
+        return None
+
+    margin = max(1, len(part) // 2)
+    best = None
+    for start in starts[~inside][:top]:
+        section_lo = max(0, int(start) - margin)
+        section_hi = min(len(score), int(start) + len(part) + margin)
+        shifted = part.copy()
+        shifted[:, 1] += score.onsets[min(max(int(start), 0), len(score) - 1)] - part[0, 1]
+        s, e, distance = find_best_matching_section(score.notes(section_lo, section_hi), shifted)
+        if best is None or distance < best[2]:
+            best = (section_lo + s, section_lo + e, distance)
+    return best[:2]
+
+def tracking(whole_midi, part_midi, start_time, seconds=window_seconds, relocalize=True):
+    """
+    Locate a chunk in the window after start_time. With a Score, a chunk
+    that fits elsewhere much better than in the window (a repeat, restart or
+    skip) is located there instead.
+    :return: best_start, best_end relative to the window and play_time
+    """
+    score = whole_midi if isinstance(whole_midi, Score) else Score.from_notes(whole_midi)
+    lo, hi = score.window(start_time, seconds)
+    whole_midi = score.notes(lo, hi)
+
+    if len(part_midi) == 0:
+        return 0, 0, start_time
+
+    jump = relocate(score, part_midi, lo, hi) if relocalize else None
+    if jump is not None:
+        best_start, best_end = jump
+        play_time = float(score.onsets[min(best_end, len(score) - 1)])
+        return best_start - lo, best_end - lo, play_time
+
+    if len(whole_midi) == 0:
+        return 0, 0, start_time
+
+    best_start, best_end, best_distance = find_best_matching_section(whole_midi, part_midi)
+    # the note after the match, or the last one when the match runs to the end
+    play_time = float(whole_midi[min(best_end, len(whole_midi) - 1), 1])
 
     return best_start, best_end, play_time
+
+def pitch_costs(score_pitches, pitch):
+    # 0 for the same pitch, 0.5 for the same pitch class, 1 otherwise
+    diff = np.abs(score_pitches - pitch)
+    return np.where(diff == 0, 0.0, np.where(diff % 12 == 0, 0.5, 1.0))
+
+class OnlineScoreFollower:
+    """
+    Online DTW (OLTW) follower of one performance through a score. Every
+    detected note adds one row to the alignment, computed only over a window
+    of score notes around the current position, so the cost of a note does
+    not grow with the score or the recording.
+    :param whole_midi: Score or List of (pitch, start, duration) for the whole MIDI
+    :param window: score notes ahead of the position the next note may match
+    :param back: score notes behind the position kept in the window
+    """
+    def __init__(self, whole_midi, window=32, back=4, position=0):
+        if not isinstance(whole_midi, Score):
+            whole_midi = Score.from_notes(whole_midi)
+        self.pitches = whole_midi.pitches
+        self.times = whole_midi.onsets
+        self.window = window
+        self.back = back
+        self.reset(position)
+
+    def reset(self, position=0):
+        self.position = position
+        self.lo = position
+        self.dist = None
+
+    def bounds(self):
+        return max(0, self.position - self.back), min(len(self.pitches), self.position + self.window)
+
+    def step(self, pitch):
+        """
+        Align one performed note.
+        :return: index of the score note the performance is at
+        """
+        lo, hi = self.bounds()
+        row = pitch_costs(self.pitches[lo:hi], pitch)
+        if self.dist is None:
+            # open begin: the first note may match anywhere in the window
+            dist = row
+        else:
+            # previous row shifted onto the new window, columns it did not cover are unreachable
+            prev = np.full(hi - lo, np.inf)
+            overlap = slice(max(lo, self.lo), min(hi, self.lo + len(self.dist)))
+            prev[overlap.start - lo:overlap.stop - lo] = self.dist[overlap.start - self.lo:overlap.stop - self.lo]
+            dist, _ = dtw_row(prev, row)
+        # keep the accumulated costs bounded, only their differences matter
+        dist = dist - dist.min()
+        self.lo, self.dist = lo, dist
+        # the cursor never moves back
+        self.position = max(self.position, lo + int(np.argmin(dist)))
+        return self.position
+
+    def push(self, notes):
+        """
+        Align the notes of a chunk as they come.
+        :param notes: List of (pitch, onset, duration) detected in the chunk
+        :return: one cursor update per note, with the score note index and
+            time and the onset of the performed note in the chunk
+        """
+        if len(self.pitches) == 0:
+            return []
+        cursors = []
+        for pitch, onset, duration in sorted(notes, key=lambda note: note[1]):
+            index = self.step(pitch)
+            cursors.append({"cursor": index, "time": float(self.times[index]), "onset": float(onset)})
+        return cursors
+
+def detect_chunk(unique_folder, stages=detection_stages, audio=None, pcm=None):
+    """
+    Detect the notes of an audio chunk.
+    :return: (n, 3) array of (pitch, onset, duration)
+    """
+    return audio_to_midi(unique_folder, stages=stages, audio=audio, pcm=pcm)
+
+# the follower path detects a chunk in windows of this many seconds, so the
+# first cursor updates go out before the whole chunk is processed; the RNN
+# sees context_seconds of the chunk on both sides of each window
+sub_window_seconds = 1.0
+context_seconds = 0.25
+
+def chunk_samples(unique_folder, audio=None, pcm=None):
+    """
+    Decode an audio chunk for detect_window.
+    :return: float32 array of mono samples at model_sample_rate
+    """
+    return np.asarray(decode_chunk(unique_folder, audio, pcm), dtype=np.float32)
+
+def sub_windows(count, seconds=sub_window_seconds, context=context_seconds):
+    """
+    Split count samples into windows for detect_window.
+    :return: list of (lo, start, stop, hi): notes starting in start:stop are
+        reported from the samples lo:hi
+    """
+    size = max(1, int(seconds * model_sample_rate))
+    pad = int(context * model_sample_rate)
+    windows = []
+    for start in range(0, count, size):
+        stop = min(start + size, count)
+        windows.append((max(0, start - pad), start, stop, min(count, stop + pad)))
+    return windows
+
+def detect_window(unique_folder, samples, lo, start, stop, stages=detection_stages):
+    """
+    Detect the notes of one sub-window of a chunk. Notes are merged within
+    the window only, so two notes just either side of a window edge stay
+    apart where detect_chunk would merge them.
+    :param samples: the chunk samples lo:hi, see sub_windows()
+    :return: (n, 3) array of (pitch, onset, duration) starting in start:stop,
+        onsets in seconds from the start of the chunk
+    """
+    signal = Signal(np.asarray(samples, dtype=np.float32), sample_rate=model_sample_rate)
+    notes = audio_to_midi(unique_folder, stages=stages, audio=signal, write_midi=False)
+    notes[:, 1] += lo / float(model_sample_rate)
+    keep = (notes[:, 1] >= start / float(model_sample_rate)) & (notes[:, 1] < stop / float(model_sample_rate))
+    return notes[keep]
+
+def track_chunk(unique_folder, whole_midi, start_time, stages=detection_stages, audio=None, pcm=None, seconds=window_seconds):
+    """
+    Detect the notes of an audio chunk and locate them in the score.
+    :param audio: encoded audio bytes, part.m4a in unique_folder if not given
+    :param pcm: format from pcm_format() when audio holds raw PCM bytes
+    :param seconds: width of the score window searched after start_time
+    :return: best_start, best_end, play_time as returned by tracking()
+    """
+    part_midi = detect_chunk(unique_folder, stages, audio, pcm)
+    return tracking(whole_midi, part_midi, start_time, seconds)
+
+if __name__ == "__main__":
+    import shutil
+    import sys
+    import tempfile
+
+    # per-chunk latency with processors built per chunk (before) and shared (after)
+    # usage: python tracking.py recording.m4a [repeats]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    folder = tempfile.mkdtemp()
+    shutil.copy(sys.argv[1], os.path.join(folder, "part.m4a"))
+    # one chunk first, so neither side pays for the imports and first calls
+    audio_to_midi(folder)
+    for label in ["per chunk", "shared"]:
+        latencies = []
+        for _ in range(repeats):
+            if label == "per chunk":
+                _processors.clear()
+            t = time.perf_counter()
+            audio_to_midi(folder)
+            latencies.append(time.perf_counter() - t)
+        print(f"{label}: mean {sum(latencies) / len(latencies):.3f}s, min {min(latencies):.3f}s")
+    shutil.rmtree(folder)